@@ -5,9 +5,19 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    # Uploads are hashed and sniffed as they stream to disk
+    from app.upload_stream import UploadRequest
+    app.request_class = UploadRequest
+
     # Create upload folder if it doesn't exist
     import os
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['EXTRACTION_CACHE_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['OCR_JOBS_FOLDER'], exist_ok=True)
+
+    # Probe OCR tools once at startup rather than on every OCR call
+    from app.ocr_processing import OCRProcessor
+    OCRProcessor.get_capabilities()
 
     # Register blueprints
     from app.routes import bp as main_bp
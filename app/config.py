@@ -10,6 +10,23 @@ class Config:
     MAX_CONTENT_LENGTH = int(os.environ.get('MAX_FILE_SIZE', 16 * 1024 * 1024))
     
     ALLOWED_EXTENSIONS = {'pdf'}
+
+    # Page window returned by /upload and served lazily by /pages
+    PAGE_WINDOW_SIZE = int(os.environ.get('PAGE_WINDOW_SIZE', 5))
+    MAX_PAGE_WINDOW_SIZE = 50
+
+    # Page ranges at least this long are extracted across a process pool
+    PARALLEL_EXTRACTION_MIN_PAGES = int(os.environ.get('PARALLEL_EXTRACTION_MIN_PAGES', 40))
+    EXTRACTION_WORKERS = int(os.environ.get('EXTRACTION_WORKERS', os.cpu_count() or 1))
+
+    # JSON responses smaller than this are sent uncompressed
+    COMPRESSION_MIN_BYTES = 1024
+
+    # Content-addressed extraction cache shared by repeat uploads
+    EXTRACTION_CACHE_FOLDER = os.environ.get('EXTRACTION_CACHE_FOLDER') or os.path.join(os.getcwd(), 'extraction_cache')
+    EXTRACTION_CACHE_MAX_BYTES = int(os.environ.get('EXTRACTION_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+    # Derived files (tiles, OCR output) trigger eviction at most this often
+    EXTRACTION_CACHE_EVICT_INTERVAL = timedelta(seconds=30)
     
     # Standard PDF fonts available
     STANDARD_FONTS = {
@@ -19,6 +36,40 @@ class Config:
         'Symbol', 'ZapfDingbats'
     }
     
+    # Open documents kept between requests
+    DOCUMENT_CACHE_MAX_BYTES = int(os.environ.get('DOCUMENT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+    DOCUMENT_CACHE_MAX_ENTRIES = int(os.environ.get('DOCUMENT_CACHE_MAX_ENTRIES', 32))
+    DOCUMENT_CACHE_IDLE = timedelta(minutes=5)
+
+    # Background OCR jobs
+    OCR_WORKERS = int(os.environ.get('OCR_WORKERS', 1))
+    OCR_JOBS_FOLDER = os.environ.get('OCR_JOBS_FOLDER') or os.path.join(os.getcwd(), 'ocr_jobs')
+    OCR_JOB_RETENTION = timedelta(hours=1)
+
+    # Revisions kept for undo/redo per document
+    EDIT_HISTORY_LIMIT = int(os.environ.get('EDIT_HISTORY_LIMIT', 50))
+
+    # Journalled edit ops are applied to the PDF at most this often
+    EDIT_FLUSH_INTERVAL = timedelta(seconds=float(os.environ.get('EDIT_FLUSH_INTERVAL', 5)))
+
+    # Documents whose span id tables are kept in memory per worker
+    SPAN_TABLE_MAX_DOCUMENTS = int(os.environ.get('SPAN_TABLE_MAX_DOCUMENTS', 64))
+
+    # Per-document search index built after upload
+    SEARCH_GRANULARITY = 'line'
+    SEARCH_INDEX_MAX_DOCUMENTS = int(os.environ.get('SEARCH_INDEX_MAX_DOCUMENTS', 16))
+    SEARCH_MAX_HITS = 500
+
+    # Page rasterization served by /render
+    RENDER_TILE_SIZE = 512  # Pixels per tile edge
+    RENDER_MIN_ZOOM = 0.25
+    RENDER_MAX_ZOOM = 4.0
+
+    # Let a front-end server stream downloads: X-Sendfile (Apache, lighttpd) or,
+    # with a prefix mapped onto UPLOAD_FOLDER, nginx's X-Accel-Redirect
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+    X_ACCEL_REDIRECT_PREFIX = os.environ.get('X_ACCEL_REDIRECT_PREFIX')
+
     # Default fallback font
     DEFAULT_FONT = 'Times-Roman'
     
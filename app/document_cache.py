@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import fitz
+from app.config import Config
+
+class _CachedDocument:
+    def __init__(self):
+        self.doc = None
+        self.stamp = None  # (mtime_ns, size) of the file the document was opened from
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()  # fitz documents are used by one request at a time
+        self.evicted = False
+        self.appended = False  # Saved incrementally since it was opened
+
+class DocumentCache:
+    """Bounded LRU of open fitz.Documents so consecutive requests skip re-parsing"""
+    _entries = OrderedDict()  # path -> _CachedDocument, least recently used first
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _file_stamp(path):
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    @staticmethod
+    @contextmanager
+    def checkout(path, writable=False):
+        """Borrow the open document for path exclusively for the duration of the block.
+
+        Read-only callers must not modify the document. Writable callers must
+        save it back to path before the block exits; if the block raises, the
+        document is discarded. A document that was saved incrementally keeps
+        serving reads, but is reopened for the next write: MuPDF would fold
+        that save into the previous increment instead of appending a new one.
+        """
+        with DocumentCache._lock:
+            entry = DocumentCache._entries.get(path)
+            if entry is None:
+                entry = DocumentCache._entries[path] = _CachedDocument()
+            DocumentCache._entries.move_to_end(path)
+
+        with entry.lock:
+            # Reopen if the file was replaced since it was parsed
+            stamp = DocumentCache._file_stamp(path)
+            if entry.doc is not None and (entry.doc.is_closed or entry.stamp != stamp or (writable and entry.appended)):
+                if not entry.doc.is_closed:
+                    entry.doc.close()
+                entry.doc = None
+            if entry.doc is None:
+                entry.doc = fitz.open(path)
+                entry.stamp = stamp
+                entry.appended = False
+
+            try:
+                yield entry.doc
+            except Exception:
+                # The document may hold half-applied changes
+                if not entry.doc.is_closed:
+                    entry.doc.close()
+                entry.doc = None
+                raise
+            finally:
+                entry.last_used = time.monotonic()
+                if entry.evicted and entry.doc is not None:
+                    # Evicted while waiting for the lock; do not leave it open untracked
+                    entry.doc.close()
+                    entry.doc = None
+                elif writable and entry.doc is not None and not entry.doc.is_closed:
+                    entry.stamp = DocumentCache._file_stamp(path)
+                    entry.appended = True
+
+        DocumentCache._evict()
+
+    @staticmethod
+    def _evict():
+        """Close idle documents, then least recently used ones until within budget"""
+        idle_cutoff = time.monotonic() - Config.DOCUMENT_CACHE_IDLE.total_seconds()
+        with DocumentCache._lock:
+            # File size stands in for the memory a parsed document holds
+            total_bytes = sum(entry.stamp[1] for entry in DocumentCache._entries.values() if entry.stamp)
+            for path, entry in list(DocumentCache._entries.items()):
+                over_budget = (
+                    total_bytes > Config.DOCUMENT_CACHE_MAX_BYTES
+                    or len(DocumentCache._entries) > Config.DOCUMENT_CACHE_MAX_ENTRIES
+                )
+                if not over_budget and entry.last_used >= idle_cutoff:
+                    continue
+                # Never close a document another request is using
+                if not entry.lock.acquire(blocking=False):
+                    continue
+                try:
+                    if entry.doc is not None and not entry.doc.is_closed:
+                        entry.doc.close()
+                    entry.doc = None
+                    entry.evicted = True
+                    del DocumentCache._entries[path]
+                    total_bytes -= entry.stamp[1] if entry.stamp else 0
+                finally:
+                    entry.lock.release()
@@ -0,0 +1,123 @@
+import fcntl
+import json
+import os
+import threading
+import time
+from app.config import Config
+from app.edit_session import EditSession
+from app.span_table import SpanTable
+
+class EditJournal:
+    """Append-only log of small {span_id: new_text} ops, folded into the PDF in batches"""
+    _dirty = set()  # Upload paths with ops this worker has not flushed yet
+    _flusher_thread = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def journal_path(filepath):
+        return f"{EditSession.working_path(filepath)}.journal"
+
+    @staticmethod
+    def _offset_path(journal_path):
+        # Byte offset up to which the journal has been applied
+        return f"{journal_path}.flushed"
+
+    @staticmethod
+    def _read_offset(journal_path):
+        try:
+            with open(EditJournal._offset_path(journal_path), 'r') as f:
+                return int(f.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    @classmethod
+    def _read_unflushed(cls, journal_path):
+        """Coalesce the ops past the flushed offset; returns (edits, start, end)"""
+        start = cls._read_offset(journal_path)
+        with open(journal_path, 'r') as journal:
+            fcntl.flock(journal, fcntl.LOCK_SH)
+            journal.seek(start)
+            data = journal.read()
+            end = journal.tell()
+
+        # The last op for a span wins
+        edits = {}
+        for line in data.splitlines():
+            edits.update(json.loads(line)['edits'])
+        return edits, start, end
+
+    @classmethod
+    def pending(cls, filepath):
+        """Ops not flushed yet, without flushing them; returns (edits, journal offset they run to)"""
+        journal_path = cls.journal_path(filepath)
+        if not os.path.exists(journal_path):
+            return {}, 0
+        edits, _, end = cls._read_unflushed(journal_path)
+        return edits, end
+
+    @classmethod
+    def append(cls, filepath, edits):
+        """Record ops for a later flush; returns the number of bytes awaiting one"""
+        journal_path = cls.journal_path(filepath)
+        line = json.dumps({'t': time.time(), 'edits': edits}, separators=(',', ':')) + '\n'
+        with open(journal_path, 'a') as journal:
+            # One write per op under the lock keeps lines whole across workers
+            fcntl.flock(journal, fcntl.LOCK_EX)
+            journal.write(line)
+            journal.flush()
+            pending = journal.tell() - cls._read_offset(journal_path)
+
+        with cls._lock:
+            cls._dirty.add(filepath)
+            if not cls._flusher_thread or not cls._flusher_thread.is_alive():
+                cls._flusher_thread = threading.Thread(target=cls._run_flusher)
+                cls._flusher_thread.daemon = True
+                cls._flusher_thread.start()
+        return pending
+
+    @classmethod
+    def flush(cls, filepath):
+        """Apply every journalled op with one save; returns the new state or None if idle"""
+        journal_path = cls.journal_path(filepath)
+        if not os.path.exists(journal_path):
+            return None
+
+        # Only one flush per journal at a time; appends never wait for it
+        with open(f"{journal_path}.flush.lock", 'w') as flush_lock:
+            fcntl.flock(flush_lock, fcntl.LOCK_EX)
+
+            edits, start, end = cls._read_unflushed(journal_path)
+            if end == start:
+                return None
+
+            # Ids were validated on append, but an OCR pass may have replaced
+            # the document since; such ops can no longer be applied
+            changes, unknown = SpanTable.resolve_edits(filepath, edits)
+            if unknown:
+                print(f"Dropping journalled edits for unknown spans: {unknown}")
+            state = EditSession.save(filepath, changes, merge=True)
+
+            with open(journal_path, 'r+') as journal:
+                fcntl.flock(journal, fcntl.LOCK_EX)
+                journal.seek(0, os.SEEK_END)
+                if journal.tell() == end:
+                    # Fully applied: start the journal afresh
+                    journal.truncate(0)
+                    end = 0
+                with open(cls._offset_path(journal_path), 'w') as f:
+                    f.write(str(end))
+            return state
+
+    @classmethod
+    def _run_flusher(cls):
+        # Ops arriving within an interval are folded into a single save
+        while True:
+            time.sleep(Config.EDIT_FLUSH_INTERVAL.total_seconds())
+            with cls._lock:
+                dirty, cls._dirty = cls._dirty, set()
+            for filepath in dirty:
+                try:
+                    if os.path.exists(filepath):
+                        cls.flush(filepath)
+                except Exception as e:
+                    print(f"Journal flush error: {str(e)}")
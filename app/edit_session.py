@@ -0,0 +1,347 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+import fitz
+from app.pdf_utils import PDFHandler
+from app.document_cache import DocumentCache
+from app.extraction_cache import ExtractionCache
+from app.revision_store import RevisionStore
+from app.config import Config
+
+class EditSession:
+    """Working copy of an upload that accumulates saves as incremental PDF updates"""
+
+    @staticmethod
+    def working_path(filepath):
+        """Path of the edited copy for an uploaded file"""
+        directory, filename = os.path.split(filepath)
+        return os.path.join(directory, f"edited_{filename}")
+
+    @staticmethod
+    def download_etag(path):
+        """Strong ETag for an upload or its working copy.
+
+        Working copies are tagged with the upload's hash, the session's epoch
+        and the edit revision, so a fresh save never requires re-hashing the
+        edited file. The epoch is drawn whenever a working copy starts over,
+        so revision numbers of an earlier session of the same file never match.
+        """
+        directory, filename = os.path.split(path)
+        if filename.startswith('edited_'):
+            filepath = os.path.join(directory, filename[len('edited_'):])
+            state = EditSession.current_state(filepath) if os.path.exists(filepath) else None
+            if state is not None:
+                return f"{ExtractionCache.hash_file(filepath)[:32]}-{state.get('epoch', 0)}-r{state['revision']}"
+        return ExtractionCache.hash_file(path)[:32]
+
+    @staticmethod
+    @contextmanager
+    def _locked(working_path):
+        """Serialize changes to a working copy across threads and workers"""
+        with open(f"{working_path}.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    @staticmethod
+    def _state_path(working_path):
+        return f"{working_path}.json"
+
+    @staticmethod
+    def _change_key(page_num, change):
+        """Identify a change by the span it replaces"""
+        return f"{int(page_num)}:" + ','.join(f"{float(v):.2f}" for v in change['bbox'])
+
+    @staticmethod
+    def current_text(state, page_num, span):
+        """Text a span shows in the working copy that state describes"""
+        change = state['applied'].get(EditSession._change_key(page_num, span)) if state else None
+        return change['new_text'] if change else span['text']
+
+    @staticmethod
+    def with_changes(state, changes):
+        """State as save(changes, merge=True) would leave its applied edits, without saving"""
+        applied = dict(state['applied']) if state else {}
+        for page_num, page_changes in changes.items():
+            for change in page_changes:
+                key = EditSession._change_key(page_num, change)
+                if change['new_text'] is None:
+                    applied.pop(key, None)
+                else:
+                    applied[key] = change
+        return dict(state or {}, applied=applied)
+
+    @staticmethod
+    def _file_stamp(path):
+        stat = os.stat(path)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    @staticmethod
+    def load_state(working_path):
+        """Return the saved session state, or None if there is none"""
+        try:
+            with open(EditSession._state_path(working_path), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_state(working_path, state):
+        state_path = EditSession._state_path(working_path)
+        tmp_path = f"{state_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+
+    @staticmethod
+    def _save_document(doc, working_path, stash_revision=None):
+        """Append to the working copy when possible, otherwise rewrite it.
+
+        Returns whether the save was incremental. An appended document stays
+        open for the cache; a rewritten file first moves the old one aside as
+        the snapshot of stash_revision, if given.
+        """
+        # can_save_incrementally() turns false once redactions are applied,
+        # although the append itself still works; only fall back when it fails
+        try:
+            doc.save(working_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+        except (ValueError, RuntimeError) as e:
+            print(f"Incremental save failed, rewriting: {str(e)}")
+        else:
+            return True
+
+        # Drop the content streams earlier saves orphaned
+        tmp_path = f"{working_path}.{os.getpid()}.tmp"
+        doc.save(tmp_path, garbage=1)
+        doc.close()
+        if stash_revision is not None:
+            RevisionStore.stash_working(working_path, stash_revision)
+        os.replace(tmp_path, working_path)
+        return False
+
+    @staticmethod
+    def _page_edit_digests(applied):
+        """Fingerprint the changes applied to each page so renders of untouched pages stay valid"""
+        per_page = {}
+        for key in sorted(applied):
+            per_page.setdefault(key.split(':')[0], []).append(applied[key])
+        return {
+            page_num: hashlib.sha256(json.dumps(page_changes, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+            for page_num, page_changes in per_page.items()
+        }
+
+    @staticmethod
+    def _is_current(filepath, working_path, state):
+        return (
+            state is not None
+            and os.path.exists(working_path)
+            and state['source'] == EditSession._file_stamp(filepath)
+            and state['working'] == EditSession._file_stamp(working_path)
+        )
+
+    @staticmethod
+    def current_state(filepath):
+        """Return the session state if the working copy still matches it, else None"""
+        working_path = EditSession.working_path(filepath)
+        state = EditSession.load_state(working_path)
+        return state if EditSession._is_current(filepath, working_path, state) else None
+
+    @staticmethod
+    def save(filepath, changes, merge=False):
+        """Bring the working copy in line with the client's change set.
+
+        By default changes is the full set of edits. With merge=True it only
+        updates the edits already applied, and a change whose new_text is None
+        reverts its span to the original text.
+        """
+        working_path = EditSession.working_path(filepath)
+
+        with EditSession._locked(working_path):
+            state = EditSession.load_state(working_path)
+            is_current = EditSession._is_current(filepath, working_path, state)
+
+            desired = {}
+            if merge and is_current:
+                desired = {key: [int(key.split(':')[0]), change] for key, change in state['applied'].items()}
+            for page_num, page_changes in changes.items():
+                for change in page_changes:
+                    key = EditSession._change_key(page_num, change)
+                    if change['new_text'] is None:
+                        desired.pop(key, None)
+                    else:
+                        desired[key] = [int(page_num), change]
+
+            if is_current:
+                previous_applied = state['applied']
+                history = state.get('history', [])
+                position = state.get('position', len(history) - 1)
+                counter = state.get('revision_counter', state['revision'])
+            else:
+                # Whatever the stored history described is gone
+                RevisionStore.clear(working_path)
+                previous_applied = {}
+                history, position = [], -1
+                counter = state.get('revision_counter', state['revision']) if state else -1
+
+            # A span reverted to its original text cannot be undone by appending,
+            # so start again from the upload in that case
+            rebuild = not is_current or any(key not in desired for key in previous_applied)
+            applied = {} if rebuild else previous_applied
+
+            pending = {}
+            for key, (page_num, change) in desired.items():
+                if applied.get(key) != change:
+                    pending.setdefault(page_num, []).append(change)
+
+            new_applied = {key: change for key, (_, change) in desired.items()}
+            if pending or rebuild:
+                # A new revision drops everything that was undone
+                RevisionStore.discard(working_path, history[position + 1:])
+                history = history[:position + 1]
+
+                replaced = rebuild and bool(history)
+                if replaced:
+                    RevisionStore.stash_working(working_path, history[-1]['revision'])
+                if rebuild:
+                    shutil.copyfile(filepath, working_path)
+                if not history:
+                    # The working copy as it stands is where undo stops
+                    counter += 1
+                    history.append({'revision': counter, 'size': os.path.getsize(working_path), 'base': True, 'delta': {}})
+
+                incremental = True
+                if pending:
+                    # Reads between saves reuse the parsed working copy; each save
+                    # reparses it so every revision is its own increment to undo
+                    with DocumentCache.checkout(working_path, writable=True) as doc:
+                        PDFHandler.apply_changes(doc, pending)
+                        incremental = EditSession._save_document(
+                            doc, working_path, None if replaced else history[-1]['revision']
+                        )
+
+                # Only the spans that changed are recorded, as [before, after]
+                delta = {
+                    key: [previous_applied.get(key), new_applied.get(key)]
+                    for key in set(previous_applied) | set(new_applied)
+                    if previous_applied.get(key) != new_applied.get(key)
+                }
+                if delta:
+                    counter += 1
+                    history.append({
+                        'revision': counter,
+                        'size': os.path.getsize(working_path),
+                        'base': replaced or not incremental,
+                        'delta': delta
+                    })
+
+                # Bound the undo depth
+                while len(history) > Config.EDIT_HISTORY_LIMIT:
+                    RevisionStore.discard(working_path, history[:1])
+                    history = history[1:]
+                position = len(history) - 1
+
+            state = {
+                'revision': history[position]['revision'] if history else state['revision'],
+                'revision_counter': counter,
+                'epoch': (is_current and state.get('epoch')) or uuid.uuid4().hex[:12],
+                'history': history,
+                'position': position,
+                'source': EditSession._file_stamp(filepath),
+                'working': EditSession._file_stamp(working_path),
+                'applied': new_applied,
+                'page_edits': EditSession._page_edit_digests(new_applied)
+            }
+            EditSession._write_state(working_path, state)
+            return state
+
+    @staticmethod
+    def step(filepath, direction):
+        """Move the working copy one revision back (-1) or forward (+1).
+
+        Returns (state, pages the step changed), or None if there is no such
+        revision to move to.
+        """
+        working_path = EditSession.working_path(filepath)
+
+        with EditSession._locked(working_path):
+            state = EditSession.load_state(working_path)
+            if not EditSession._is_current(filepath, working_path, state) or not state.get('history'):
+                return None
+            history, position = state['history'], state['position']
+            target = position + direction
+            if not 0 <= target < len(history):
+                return None
+
+            applied = dict(state['applied'])
+            if direction < 0:
+                entry = history[position]
+                RevisionStore.step_back(working_path, entry, history[target])
+                restored = {key: before for key, (before, _) in entry['delta'].items()}
+            else:
+                entry = history[target]
+                RevisionStore.step_forward(working_path, history[position], entry)
+                restored = {key: after for key, (_, after) in entry['delta'].items()}
+            for key, change in restored.items():
+                if change is None:
+                    applied.pop(key, None)
+                else:
+                    applied[key] = change
+
+            state.update(
+                revision=history[target]['revision'],
+                position=target,
+                working=EditSession._file_stamp(working_path),
+                applied=applied,
+                page_edits=EditSession._page_edit_digests(applied)
+            )
+            EditSession._write_state(working_path, state)
+            return state, sorted({int(key.split(':')[0]) for key in entry['delta']})
+
+    @staticmethod
+    def replace_source(filepath, new_path):
+        """Move a new version of the upload (its OCR output) into place, keeping saved edits.
+
+        Without this the next save would find the session stale and start
+        over from the new upload. Instead the working copy is rebuilt from it
+        with the applied edits re-applied, as a revision undo can step over.
+        """
+        working_path = EditSession.working_path(filepath)
+
+        with EditSession._locked(working_path):
+            state = EditSession.load_state(working_path)
+            is_current = EditSession._is_current(filepath, working_path, state)
+            os.replace(new_path, filepath)
+            if not is_current or not state['applied']:
+                return
+
+            history = state['history']
+            RevisionStore.discard(working_path, history[state['position'] + 1:])
+            history = history[:state['position'] + 1]
+            RevisionStore.stash_working(working_path, history[-1]['revision'])
+            shutil.copyfile(filepath, working_path)
+
+            pending = {}
+            for key, change in state['applied'].items():
+                pending.setdefault(int(key.split(':')[0]), []).append(change)
+            with DocumentCache.checkout(working_path, writable=True) as doc:
+                PDFHandler.apply_changes(doc, pending)
+                EditSession._save_document(doc, working_path)
+
+            counter = state.get('revision_counter', state['revision']) + 1
+            history.append({'revision': counter, 'size': os.path.getsize(working_path), 'base': True, 'delta': {}})
+            while len(history) > Config.EDIT_HISTORY_LIMIT:
+                RevisionStore.discard(working_path, history[:1])
+                history = history[1:]
+
+            state.update(
+                revision=counter,
+                revision_counter=counter,
+                history=history,
+                position=len(history) - 1,
+                source=EditSession._file_stamp(filepath),
+                working=EditSession._file_stamp(working_path)
+            )
+            EditSession._write_state(working_path, state)
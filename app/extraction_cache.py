@@ -0,0 +1,176 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from app.config import Config
+
+class ExtractionCache:
+    """Content-addressed on-disk cache of extracted page spans"""
+    # Span dicts are stored as positional rows to avoid repeating keys;
+    # the trailing 'lines' field is only written for merged multi-line blocks
+    SPAN_FIELDS = ('text', 'bbox', 'font', 'size', 'flags', 'color', 'lines')
+
+    _hash_memo = {}  # filepath -> (mtime_ns, size, digest)
+    _last_evicted = None  # monotonic time of the last throttled eviction
+    _lock = threading.Lock()
+
+    @staticmethod
+    def hash_file(filepath):
+        """SHA-256 of a file, memoized until the file changes on disk"""
+        stat = os.stat(filepath)
+        with ExtractionCache._lock:
+            memo = ExtractionCache._hash_memo.get(filepath)
+        if memo and memo[0] == stat.st_mtime_ns and memo[1] == stat.st_size:
+            return memo[2]
+
+        sha = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+
+        with ExtractionCache._lock:
+            ExtractionCache._hash_memo[filepath] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    @staticmethod
+    def remember_hash(filepath, digest):
+        """Record a digest computed while the file was being written"""
+        stat = os.stat(filepath)
+        with ExtractionCache._lock:
+            ExtractionCache._hash_memo[filepath] = (stat.st_mtime_ns, stat.st_size, digest)
+
+    @staticmethod
+    def make_key(digest, version):
+        """Cache key for a document digest and extractor version"""
+        return f"{digest}-v{version}"
+
+    @staticmethod
+    def _entry_dir(key):
+        return os.path.join(Config.EXTRACTION_CACHE_FOLDER, key)
+
+    @staticmethod
+    def _write_atomic(path, data):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def get_meta(key):
+        """Return cached document metadata (page count) and mark the entry as recently used"""
+        entry_dir = ExtractionCache._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+            os.utime(entry_dir)
+            return meta
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def put_meta(key, meta):
+        """Store document metadata for a cache entry"""
+        entry_dir = ExtractionCache._entry_dir(key)
+        os.makedirs(entry_dir, exist_ok=True)
+        ExtractionCache._write_atomic(
+            os.path.join(entry_dir, 'meta.json'), json.dumps(meta).encode('utf-8')
+        )
+
+    @staticmethod
+    def _page_path(key, page_num, granularity):
+        return os.path.join(ExtractionCache._entry_dir(key), f"{page_num}.{granularity}.json.gz")
+
+    @staticmethod
+    def get_page(key, page_num, granularity='span'):
+        """Return the cached span list for one page, or None on a miss"""
+        path = ExtractionCache._page_path(key, page_num, granularity)
+        try:
+            with gzip.open(path, 'rb') as f:
+                rows = json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        return [dict(zip(ExtractionCache.SPAN_FIELDS, row)) for row in rows]
+
+    @staticmethod
+    def put_page(key, page_num, spans, granularity='span'):
+        """Store the span list for one page in compact gzipped row form"""
+        os.makedirs(ExtractionCache._entry_dir(key), exist_ok=True)
+        rows = []
+        for span in spans:
+            fields = ExtractionCache.SPAN_FIELDS if 'lines' in span else ExtractionCache.SPAN_FIELDS[:-1]
+            rows.append([span[field] for field in fields])
+        data = gzip.compress(json.dumps(rows, separators=(',', ':')).encode('utf-8'))
+        ExtractionCache._write_atomic(ExtractionCache._page_path(key, page_num, granularity), data)
+
+    @staticmethod
+    def get_file(key, name):
+        """Return the path of a file stored alongside a cache entry, or None"""
+        path = os.path.join(ExtractionCache._entry_dir(key), name)
+        return path if os.path.exists(path) else None
+
+    @staticmethod
+    def put_file(key, name, source_path):
+        """Copy a derived file (e.g. an OCR result) into a cache entry"""
+        entry_dir = ExtractionCache._entry_dir(key)
+        os.makedirs(entry_dir, exist_ok=True)
+        tmp_path = os.path.join(entry_dir, f"{name}.{os.getpid()}.tmp")
+        shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, os.path.join(entry_dir, name))
+        ExtractionCache.evict_in_background(throttled=True)
+
+    @staticmethod
+    def put_file_data(key, name, data):
+        """Store derived bytes (e.g. a rendered tile) in a cache entry"""
+        entry_dir = ExtractionCache._entry_dir(key)
+        os.makedirs(entry_dir, exist_ok=True)
+        ExtractionCache._write_atomic(os.path.join(entry_dir, name), data)
+        ExtractionCache.evict_in_background(throttled=True)
+
+    @staticmethod
+    def evict():
+        """Remove least recently used entries until the cache fits its size budget"""
+        cache_dir = Config.EXTRACTION_CACHE_FOLDER
+        if not os.path.isdir(cache_dir):
+            return
+
+        entries = []
+        total_size = 0
+        for entry in os.scandir(cache_dir):
+            if not entry.is_dir():
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+                entries.append((entry.stat().st_mtime, size, entry.path))
+            except OSError:
+                continue
+            total_size += size
+
+        if total_size <= Config.EXTRACTION_CACHE_MAX_BYTES:
+            return
+
+        # Oldest access time first
+        for _, size, path in sorted(entries):
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+            if total_size <= Config.EXTRACTION_CACHE_MAX_BYTES:
+                break
+
+    @staticmethod
+    def evict_in_background(throttled=False):
+        """Run eviction off the request thread.
+
+        Throttled calls come from every stored derived file, so they start
+        at most one eviction per EXTRACTION_CACHE_EVICT_INTERVAL.
+        """
+        if throttled:
+            now = time.monotonic()
+            with ExtractionCache._lock:
+                last = ExtractionCache._last_evicted
+                if last is not None and now - last < Config.EXTRACTION_CACHE_EVICT_INTERVAL.total_seconds():
+                    return
+                ExtractionCache._last_evicted = now
+        threading.Thread(target=ExtractionCache.evict, daemon=True).start()
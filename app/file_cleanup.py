@@ -1,80 +1,143 @@
 import os
+import fcntl
+import sqlite3
 import time
 from datetime import datetime, timedelta
 import threading
 from app.config import Config
+from app.session_storage import SessionStorage
 
 class FileCleanup:
+    """Session expiry registry shared by all workers through SQLite, reaped by one elected worker"""
     _cleanup_thread = None
-    _active_sessions = {}  # Track active file sessions and their expiry times
+    _leader_lock_file = None  # Held open for as long as this process is the reaper
+    _condition = threading.Condition()
+    _wakeup_pending = False
+    _initialized_for = None
+
+    @staticmethod
+    def _registry_dir():
+        # Hidden so upload-folder sweeps leave it alone
+        return os.path.join(Config.UPLOAD_FOLDER, '.registry')
 
     @classmethod
-    def start_countdown_thread(cls, initial_time, filename):
-        """Start or update countdown for a specific file"""
-        now = datetime.now()
-        expiry_time = now + timedelta(minutes=initial_time)
-        cls._active_sessions[filename] = expiry_time
+    def _connect(cls):
+        """Open a connection to the shared registry, creating it on first use"""
+        registry_dir = cls._registry_dir()
+        conn = sqlite3.connect(os.path.join(registry_dir, 'expiry.sqlite3'), timeout=10, isolation_level=None)
+        if cls._initialized_for != registry_dir:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS sessions (token TEXT PRIMARY KEY, expires_at REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS sessions_by_expiry ON sessions (expires_at)')
+            cls._initialized_for = registry_dir
+        return conn
 
-        def countdown():
-            while True:
-                now = datetime.now()
-                # Get earliest expiry time
-                if not cls._active_sessions:
-                    break
+    @classmethod
+    def start_countdown_thread(cls, initial_time, token):
+        """Start or update countdown for a session"""
+        cls.schedule(token, datetime.now() + timedelta(minutes=initial_time))
 
-                # Show time until next file expires
-                earliest_expiry = min(cls._active_sessions.values())
-                remaining = earliest_expiry - now
-                
-                if remaining.total_seconds() <= 0:
-                    # Remove expired sessions
-                    expired = [f for f, t in cls._active_sessions.items() if t <= now]
-                    for f in expired:
-                        del cls._active_sessions[f]
-                        try:
-                            filepath = os.path.join(Config.UPLOAD_FOLDER, f)
-                            if os.path.exists(filepath):
-                                os.remove(filepath)
-                                print(f"\nRemoved expired file: {f}")
-                        except Exception as e:
-                            print(f"\nError removing file {f}: {str(e)}")
-                
-                if not cls._active_sessions:
-                    break
+    @classmethod
+    def schedule(cls, token, expiry_time):
+        """Insert or renew the expiry of a session"""
+        os.makedirs(cls._registry_dir(), exist_ok=True)
+        conn = cls._connect()
+        try:
+            conn.execute(
+                'INSERT INTO sessions (token, expires_at) VALUES (?, ?) '
+                'ON CONFLICT (token) DO UPDATE SET expires_at = excluded.expires_at',
+                (token, expiry_time.timestamp())
+            )
+        finally:
+            conn.close()
 
-                minutes = int(remaining.total_seconds() // 60)
-                seconds = int(remaining.total_seconds() % 60)
-                print(f"\rActive sessions: {len(cls._active_sessions)} - Next cleanup in: {minutes:02d}:{seconds:02d}", end='', flush=True)
-                time.sleep(1)
+        with cls._condition:
+            # Every worker runs a reaper thread; only the elected one reaps
+            if not cls._cleanup_thread or not cls._cleanup_thread.is_alive():
+                cls._cleanup_thread = threading.Thread(target=cls._run_reaper)
+                cls._cleanup_thread.daemon = True
+                cls._cleanup_thread.start()
+            cls._wakeup_pending = True
+            cls._condition.notify()
 
-        # Start new thread if not running
-        if not cls._cleanup_thread or not cls._cleanup_thread.is_alive():
-            cls._cleanup_thread = threading.Thread(target=countdown)
-            cls._cleanup_thread.daemon = True
-            cls._cleanup_thread.start()
+    @classmethod
+    def get_expiry(cls, token):
+        """Return when a session expires, or None if it is not registered"""
+        if not os.path.isdir(cls._registry_dir()):
+            return None
+        conn = cls._connect()
+        try:
+            row = conn.execute('SELECT expires_at FROM sessions WHERE token = ?', (token,)).fetchone()
+        finally:
+            conn.close()
+        return datetime.fromtimestamp(row[0]) if row else None
 
     @classmethod
-    def remove_session(cls, filename):
-        """Remove a file session when done"""
-        if filename in cls._active_sessions:
-            del cls._active_sessions[filename]
+    def _try_become_reaper(cls):
+        """Take the reaper lock if no other worker holds it"""
+        lock_file = open(os.path.join(cls._registry_dir(), 'reaper.lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        # The lock is released by the OS if this worker dies, so another can take over
+        cls._leader_lock_file = lock_file
+        return True
 
     @classmethod
-    def force_cleanup(cls):
-        """Force immediate cleanup of all files"""
-        upload_dir = Config.UPLOAD_FOLDER
-        
-        if not os.path.exists(upload_dir):
-            return
-            
-        # Clear all active sessions
-        cls._active_sessions.clear()
-        
-        # Immediately remove all files
-        for filename in os.listdir(upload_dir):
+    def _reap_expired(cls):
+        """Delete expired registry rows and their session directories; return the next deadline"""
+        now = time.time()
+        conn = cls._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            expired = [row[0] for row in conn.execute('SELECT token FROM sessions WHERE expires_at <= ?', (now,))]
+            conn.execute('DELETE FROM sessions WHERE expires_at <= ?', (now,))
+            conn.execute('COMMIT')
+            next_expiry = conn.execute('SELECT MIN(expires_at) FROM sessions').fetchone()[0]
+        finally:
+            conn.close()
+
+        for token in expired:
+            SessionStorage.teardown(token)
+
+        return next_expiry
+
+    @classmethod
+    def _run_reaper(cls):
+        # Deadlines set by other workers are only seen on the next check, so never
+        # sleep longer than the cleanup interval
+        max_wait = Config.CLEANUP_INTERVAL.total_seconds()
+        while True:
             try:
-                filepath = os.path.join(upload_dir, filename)
-                os.remove(filepath)
-                print(f"\nForce removed: {filename}")
+                if cls._leader_lock_file is None and not cls._try_become_reaper():
+                    wait = max_wait
+                else:
+                    next_expiry = cls._reap_expired()
+                    wait = max_wait if next_expiry is None else min(max(next_expiry - time.time(), 0), max_wait)
             except Exception as e:
-                print(f"\nError removing file {filename}: {str(e)}")
+                print(f"Cleanup error: {str(e)}")
+                wait = max_wait
+
+            with cls._condition:
+                if not cls._wakeup_pending:
+                    cls._condition.wait(wait)
+                cls._wakeup_pending = False
+
+    @classmethod
+    def remove_session(cls, token):
+        """Forget a session's expiry without touching its files"""
+        if not os.path.isdir(cls._registry_dir()):
+            return
+        conn = cls._connect()
+        try:
+            conn.execute('DELETE FROM sessions WHERE token = ?', (token,))
+        finally:
+            conn.close()
+
+    @classmethod
+    def force_cleanup(cls, token):
+        """Force immediate cleanup of one session's files"""
+        cls.remove_session(token)
+        SessionStorage.teardown(token)
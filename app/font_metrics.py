@@ -0,0 +1,81 @@
+import functools
+import threading
+from array import array
+import fitz
+from app.config import Config
+from app.font_utils import get_fallback_font
+
+class FontMetrics:
+    """Glyph advance tables for the standard PDF fonts, loaded once per process"""
+    # PyMuPDF short names that may appear in extracted spans
+    SHORT_NAMES = {
+        'helv': 'Helvetica', 'hebo': 'Helvetica-Bold', 'heit': 'Helvetica-Oblique',
+        'hebi': 'Helvetica-BoldOblique', 'tiro': 'Times-Roman', 'tibo': 'Times-Bold',
+        'tiit': 'Times-Italic', 'tibi': 'Times-BoldItalic', 'cour': 'Courier',
+        'cobo': 'Courier-Bold', 'coit': 'Courier-Oblique', 'cobi': 'Courier-BoldOblique',
+        'symb': 'Symbol', 'zadb': 'ZapfDingbats'
+    }
+
+    # Code points below this are served from a flat array per font
+    TABLE_SIZE = 256
+
+    _fonts = {}
+    _tables = {}
+    _wide_glyphs = {}  # (font_name, code point) -> advance, for text outside the table
+    _lock = threading.Lock()
+
+    @staticmethod
+    def load():
+        """Load every standard font and its advance table once"""
+        with FontMetrics._lock:
+            if FontMetrics._fonts:
+                return
+            for font_name in Config.STANDARD_FONTS:
+                font = fitz.Font(font_name)
+                FontMetrics._tables[font_name] = array(
+                    'd', (font.glyph_advance(cp) for cp in range(FontMetrics.TABLE_SIZE))
+                )
+                FontMetrics._fonts[font_name] = font
+
+    @staticmethod
+    def resolve(font_name):
+        """Map any span font name onto one of the standard fonts"""
+        if font_name in Config.STANDARD_FONTS:
+            return font_name
+        if font_name in FontMetrics.SHORT_NAMES:
+            return FontMetrics.SHORT_NAMES[font_name]
+        fallback = get_fallback_font(font_name or '')
+        return fallback if fallback in Config.STANDARD_FONTS else Config.DEFAULT_FONT
+
+    @staticmethod
+    def get_font(font_name):
+        """Return the shared fitz.Font for a (resolved) font name"""
+        FontMetrics.load()
+        return FontMetrics._fonts[FontMetrics.resolve(font_name)]
+
+    @staticmethod
+    def _wide_glyph_advance(font_name, cp):
+        key = (font_name, cp)
+        advance = FontMetrics._wide_glyphs.get(key)
+        if advance is None:
+            advance = FontMetrics._fonts[font_name].glyph_advance(cp)
+            FontMetrics._wide_glyphs[key] = advance
+        return advance
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def text_width(text, font_name, font_size):
+        """Width of text in points, memoized per (text, font, size)"""
+        FontMetrics.load()
+        font_name = FontMetrics.resolve(font_name)
+        table = FontMetrics._tables[font_name]
+
+        try:
+            # Single C-level pass over the byte values for Latin-1 text
+            units = sum(map(table.__getitem__, text.encode('latin-1')))
+        except UnicodeEncodeError:
+            units = sum(
+                table[cp] if cp < FontMetrics.TABLE_SIZE else FontMetrics._wide_glyph_advance(font_name, cp)
+                for cp in map(ord, text)
+            )
+        return units * font_size
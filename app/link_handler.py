@@ -1,5 +1,6 @@
 import re
 from fitz import Document
+from app.font_metrics import FontMetrics
 
 class LinkHandler:
     # Regular expressions for links and emails
@@ -52,8 +53,8 @@ class LinkHandler:
                 fontsize=font_size
             )
             
-            # Add underline
-            text_width = page.get_text_width(text, fontsize=font_size)
+            # Add underline (insert_text defaults to Helvetica)
+            text_width = FontMetrics.text_width(text, 'Helvetica', font_size)
             page.draw_line(
                 start=(x0, y1 + 1),
                 end=(x0 + text_width, y1 + 1),
@@ -0,0 +1,177 @@
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from ocrmypdf import hookimpl
+from app.config import Config
+from app.edit_session import EditSession
+from app.extraction_cache import ExtractionCache
+from app.ocr_processing import OCRProcessor
+from app.pdf_utils import PDFHandler
+
+# Job handled by this pool worker; each worker runs one job at a time
+_current_job_id = None
+
+class JobProgressBar:
+    """ocrmypdf progress bar that records progress in the current job's status file"""
+
+    def __init__(self, *, total=None, desc=None, unit=None, disable=False, **kwargs):
+        self.total = total
+        self.desc = desc
+        self.unit = unit
+        self.completed = 0
+
+    def __enter__(self):
+        self._report()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def update(self, n=1, *, completed=None):
+        self.completed = completed if completed is not None else self.completed + n
+        self._report()
+
+    def _report(self):
+        if _current_job_id is None:
+            return
+        progress = {'stage': self.desc}
+        # Only page-based steps map onto per-page progress
+        if self.unit == 'page' and self.total:
+            progress['pages_done'] = int(self.completed)
+            progress['pages_total'] = int(self.total)
+        OCRJobQueue.update_job(_current_job_id, **progress)
+
+@hookimpl
+def get_progressbar_class():
+    return JobProgressBar
+
+def _merge_into_cache(filepath, cache_key, pages):
+    """Reuse cached spans of untouched pages and extract only the OCR'd ones"""
+    new_key = ExtractionCache.make_key(ExtractionCache.hash_file(filepath), PDFHandler.EXTRACTOR_VERSION)
+    meta = ExtractionCache.get_meta(cache_key) or {'page_count': PDFHandler.get_page_count(filepath)}
+
+    ocr_pages = set(pages)
+    for granularity in PDFHandler.GRANULARITIES:
+        for page_num in range(meta['page_count']):
+            if page_num in ocr_pages:
+                continue
+            spans = ExtractionCache.get_page(cache_key, page_num, granularity)
+            if spans is not None:
+                ExtractionCache.put_page(new_key, page_num, spans, granularity)
+
+    # Other granularities of the OCR'd pages are extracted when first requested
+    for page_num in pages:
+        for extracted_num, spans in PDFHandler.iter_text_with_attributes(filepath, page_num, 1, parallel=False):
+            ExtractionCache.put_page(new_key, extracted_num, spans)
+
+    ExtractionCache.put_meta(new_key, {'page_count': meta['page_count'], 'image_only_pages': []})
+
+def _run_job(job_id, filepath, cache_key, pages):
+    """Pool worker: OCR the given pages of an upload in place and record the outcome"""
+    global _current_job_id
+    _current_job_id = job_id
+    try:
+        OCRJobQueue.update_job(job_id, status='running')
+        # Failures raise, so the job records their actual cause
+        ocr_path = OCRProcessor.process_pdf(filepath, plugins=[__name__], pages=pages, raise_errors=True)
+        ExtractionCache.put_file(cache_key, 'ocr.pdf', ocr_path)
+        # Later windows and edits must see the OCR text layer. The output is
+        # in the system temp dir, so copy it next to the upload first and
+        # swap it in with a rename readers never see half done; edits saved
+        # meanwhile are carried over onto it
+        directory, filename = os.path.split(filepath)
+        tmp_path = os.path.join(directory, f".{filename}.{os.getpid()}.ocr.tmp")
+        shutil.copyfile(ocr_path, tmp_path)
+        EditSession.replace_source(filepath, tmp_path)
+        os.remove(ocr_path)
+        _merge_into_cache(filepath, cache_key, pages)
+        OCRJobQueue.update_job(job_id, status='done')
+    except Exception as e:
+        print(f"OCR job error: {str(e)}")
+        OCRJobQueue.update_job(job_id, status='failed', error=str(e))
+    finally:
+        _current_job_id = None
+
+class OCRJobQueue:
+    """Runs OCR off the request path in a local process pool"""
+    JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+    _executor = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _get_executor():
+        with OCRJobQueue._lock:
+            if OCRJobQueue._executor is None:
+                OCRJobQueue._executor = ProcessPoolExecutor(
+                    max_workers=Config.OCR_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return OCRJobQueue._executor
+
+    @staticmethod
+    def _job_path(job_id):
+        return os.path.join(Config.OCR_JOBS_FOLDER, f"{job_id}.json")
+
+    @staticmethod
+    def get_job(job_id):
+        """Return a job's status, or None for unknown ids"""
+        if not OCRJobQueue.JOB_ID_PATTERN.match(job_id):
+            return None
+        try:
+            with open(OCRJobQueue._job_path(job_id), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def update_job(job_id, **fields):
+        """Merge fields into a job's status file"""
+        job = OCRJobQueue.get_job(job_id) or {}
+        job.update(fields, updated_at=time.time())
+
+        # Status files are read from any web worker, so replace them atomically
+        path = OCRJobQueue._job_path(job_id)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, path)
+        return job
+
+    @staticmethod
+    def prune_jobs():
+        """Remove status files of jobs that finished long ago"""
+        cutoff = time.time() - Config.OCR_JOB_RETENTION.total_seconds()
+        for entry in os.scandir(Config.OCR_JOBS_FOLDER):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def submit(filepath, filename, cache_key, pages):
+        """Queue OCR of the given pages of an upload and return the job id"""
+        os.makedirs(Config.OCR_JOBS_FOLDER, exist_ok=True)
+        OCRJobQueue.prune_jobs()
+
+        job_id = uuid.uuid4().hex
+        OCRJobQueue.update_job(
+            job_id,
+            id=job_id,
+            filename=filename,
+            pages=pages,
+            status='queued',
+            stage=None,
+            pages_done=0,
+            pages_total=None,
+            error=None
+        )
+        OCRJobQueue._get_executor().submit(_run_job, job_id, filepath, cache_key, pages)
+        return job_id
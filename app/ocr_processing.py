@@ -4,27 +4,75 @@ from pathlib import Path
 import shutil
 import subprocess
 import os
+import threading
+import time
 
 class OCRProcessor:
+    _capabilities = None
+    _capabilities_lock = threading.Lock()
+
     @staticmethod
-    def check_dependencies():
-        """Check if required dependencies are available"""
+    def _probe_output(command):
+        """Run a probe command and return its output lines, or None if it is unavailable"""
         try:
-            # Check Ghostscript
-            subprocess.run(['gs', '--version'], check=True, capture_output=True)
-            # Check Tesseract
-            subprocess.run(['tesseract', '--version'], check=True, capture_output=True)
-            return True
+            result = subprocess.run(command, check=True, capture_output=True, text=True, timeout=10)
+            # Older Tesseract releases print to stderr
+            return (result.stdout or result.stderr).strip().splitlines()
         except (subprocess.SubprocessError, FileNotFoundError):
-            return False
+            return None
 
     @staticmethod
-    def process_pdf(input_path):
-        """Process PDF with OCR if possible, otherwise return original file"""
+    def get_capabilities(refresh=False):
+        """Probe OCR tools once per process and return the cached result"""
+        with OCRProcessor._capabilities_lock:
+            if OCRProcessor._capabilities is None or refresh:
+                gs_output = OCRProcessor._probe_output(['gs', '--version'])
+                tesseract_output = OCRProcessor._probe_output(['tesseract', '--version'])
+                languages = []
+                if tesseract_output is not None:
+                    # First line is a "List of available languages" header
+                    languages = (OCRProcessor._probe_output(['tesseract', '--list-langs']) or [])[1:]
+
+                OCRProcessor._capabilities = {
+                    'ghostscript': {
+                        'available': gs_output is not None,
+                        'version': gs_output[0] if gs_output else None
+                    },
+                    'tesseract': {
+                        'available': tesseract_output is not None,
+                        'version': tesseract_output[0] if tesseract_output else None,
+                        'languages': [lang.strip() for lang in languages if lang.strip()]
+                    },
+                    'ocr_available': gs_output is not None and tesseract_output is not None,
+                    'probed_at': time.time()
+                }
+            return OCRProcessor._capabilities
+
+    @staticmethod
+    def missing_tools():
+        """Names of the OCR tools the capability probe did not find"""
+        capabilities = OCRProcessor.get_capabilities()
+        return [tool for tool in ('ghostscript', 'tesseract') if not capabilities[tool]['available']]
+
+    @staticmethod
+    def check_dependencies():
+        """Check if required dependencies are available"""
+        return OCRProcessor.get_capabilities()['ocr_available']
+
+    @staticmethod
+    def process_pdf(input_path, plugins=None, pages=None, raise_errors=False):
+        """Process PDF with OCR if possible, otherwise return original file.
+
+        With raise_errors=True a failure raises instead, so callers can
+        report why OCR did not happen.
+        """
         if not OCRProcessor.check_dependencies():
+            if raise_errors:
+                raise RuntimeError(f"OCR is unavailable, missing: {', '.join(OCRProcessor.missing_tools())}")
             print("Warning: Missing dependencies. Please run setup_dependencies.sh")
             return input_path
 
+        output_path = None
         try:
             with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp_file:
                 output_path = tmp_file.name
@@ -38,9 +86,16 @@ class OCRProcessor:
                 output_type='pdf',
                 use_threads=True,
                 language='eng',
-                progress_bar=False
+                progress_bar=False,
+                plugins=plugins,
+                # Zero-based page numbers; other pages pass through untouched
+                pages=','.join(str(page + 1) for page in pages) if pages else None
             )
             return output_path
         except Exception as e:
+            if output_path and os.path.exists(output_path):
+                os.remove(output_path)
+            if raise_errors:
+                raise
             print(f"OCR processing failed: {str(e)}")
             return input_path
@@ -0,0 +1,130 @@
+import io
+import math
+import fitz
+from PIL import Image
+from app.config import Config
+from app.document_cache import DocumentCache
+from app.edit_session import EditSession
+from app.extraction_cache import ExtractionCache
+from app.pdf_utils import PDFHandler
+
+class PageRenderer:
+    """Rasterizes page tiles and caches them by document content and page edits"""
+    MIMETYPES = {'png': 'image/png', 'webp': 'image/webp'}
+
+    @staticmethod
+    def clamp_zoom(zoom):
+        # Rounded so near-identical zoom levels share cached tiles
+        return round(min(max(zoom, Config.RENDER_MIN_ZOOM), Config.RENDER_MAX_ZOOM), 2)
+
+    @staticmethod
+    def source_for(filepath):
+        """Return the file to render and the per-page edit fingerprints that apply to it"""
+        state = EditSession.current_state(filepath)
+        if state is None:
+            return filepath, {}
+        return EditSession.working_path(filepath), state.get('page_edits', {})
+
+    @staticmethod
+    def tile_name(digest, page_num, page_edit, zoom, tile, fmt):
+        """Cache file name of a rendered tile; doubles as its ETag.
+
+        Names carry the upload's hash, so a different document uploaded under
+        the same name never revalidates against an earlier one's tiles.
+        """
+        tile_part = 'full' if tile is None else f"{tile[0]}-{tile[1]}"
+        return f"tile-{digest[:16]}-{page_num}-{page_edit or 'orig'}-z{zoom}-{tile_part}.{fmt}"
+
+    @staticmethod
+    def etag_for(filepath, page_num, zoom, tile=None, fmt='png'):
+        """ETag a render would carry, known without rendering"""
+        _, page_edits = PageRenderer.source_for(filepath)
+        return PageRenderer.tile_name(
+            ExtractionCache.hash_file(filepath), page_num, page_edits.get(str(page_num)), zoom, tile, fmt
+        )
+
+    @staticmethod
+    def tile_grid(page_rect, zoom):
+        """Number of tile columns and rows covering a page at a zoom level"""
+        size = Config.RENDER_TILE_SIZE
+        return (
+            max(math.ceil(page_rect.width * zoom / size), 1),
+            max(math.ceil(page_rect.height * zoom / size), 1)
+        )
+
+    @staticmethod
+    def rasterize(page, zoom, tile, fmt):
+        """Render a whole page, or one tile of it, to encoded image bytes"""
+        clip = None
+        if tile is not None:
+            # Tile edges are in device pixels; map them back to page space
+            edge = Config.RENDER_TILE_SIZE / zoom
+            x0 = page.rect.x0 + tile[0] * edge
+            y0 = page.rect.y0 + tile[1] * edge
+            clip = fitz.Rect(x0, y0, x0 + edge, y0 + edge) & page.rect
+
+        pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False)
+        if fmt == 'png':
+            return pixmap.tobytes('png')
+
+        # PyMuPDF has no WebP encoder of its own
+        image = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+        buffer = io.BytesIO()
+        image.save(buffer, format='WEBP', quality=80, method=4)
+        return buffer.getvalue()
+
+    @staticmethod
+    def render(filepath, page_num, zoom, tile=None, fmt='png'):
+        """Return (tile path or in-memory file, etag), rendering only on a cache miss.
+
+        Raises IndexError for pages or tiles outside the document.
+        """
+        render_path, page_edits = PageRenderer.source_for(filepath)
+        digest = ExtractionCache.hash_file(filepath)
+        key = ExtractionCache.make_key(digest, PDFHandler.EXTRACTOR_VERSION)
+        name = PageRenderer.tile_name(digest, page_num, page_edits.get(str(page_num)), zoom, tile, fmt)
+
+        cached_path = ExtractionCache.get_file(key, name)
+        if cached_path:
+            return cached_path, name
+
+        with DocumentCache.checkout(render_path) as doc:
+            if not 0 <= page_num < doc.page_count:
+                raise IndexError('Page out of range')
+            page = doc[page_num]
+            if tile is not None:
+                columns, rows = PageRenderer.tile_grid(page.rect, zoom)
+                if not (0 <= tile[0] < columns and 0 <= tile[1] < rows):
+                    raise IndexError('Tile out of range')
+            data = PageRenderer.rasterize(page, zoom, tile, fmt)
+
+        # An edit saved while rendering may have changed the page under us;
+        # serve what was rendered but do not cache it under the old fingerprint
+        if PageRenderer.source_for(filepath) != (render_path, page_edits):
+            return io.BytesIO(data), None
+
+        ExtractionCache.put_file_data(key, name, data)
+        # Eviction may already have removed it again
+        return ExtractionCache.get_file(key, name) or io.BytesIO(data), name
+
+    @staticmethod
+    def preview(filepath, changes, zoom, fmt='png'):
+        """Rasterize the pages a change set touches without saving anything.
+
+        Changes are applied to a throwaway in-memory copy of the upload, the
+        same way /edit would apply them. Raises IndexError for unknown pages.
+        """
+        page_count = PDFHandler.get_page_count(filepath)
+        if any(not 0 <= int(page_num) < page_count for page_num in changes):
+            raise IndexError('Page out of range')
+        if not changes:
+            return {}
+
+        doc = PDFHandler.update_text(filepath, changes)
+        try:
+            return {
+                int(page_num): PageRenderer.rasterize(doc[int(page_num)], zoom, None, fmt)
+                for page_num in changes
+            }
+        finally:
+            doc.close()
@@ -0,0 +1,73 @@
+import gzip
+from flask import request
+from app.config import Config
+
+try:
+    import brotli
+except ImportError:  # Optional: responses fall back to gzip
+    brotli = None
+
+class PayloadFormat:
+    """Compact encodings for large extraction responses"""
+
+    @staticmethod
+    def to_columnar(pages):
+        """Turn {page: [span, ...]} into parallel arrays with interned font and color tables"""
+        fonts = {}
+        colors = {}
+        columnar_pages = {}
+
+        for page_num, spans in pages.items():
+            columns = {'text': [], 'bbox': [], 'size': [], 'flags': [], 'font': [], 'color': []}
+            for span in spans:
+                color = tuple(span['color'])
+                columns['text'].append(span['text'])
+                columns['bbox'].extend(span['bbox'])  # Flattened, four numbers per span
+                columns['size'].append(span['size'])
+                columns['flags'].append(span['flags'])
+                columns['font'].append(fonts.setdefault(span['font'], len(fonts)))
+                columns['color'].append(colors.setdefault(color, len(colors)))
+                if 'id' in span:
+                    columns.setdefault('id', []).append(span['id'])
+                if 'lines' in span:
+                    # Sparse: only merged multi-line blocks carry line boxes
+                    columns.setdefault('lines', {})[len(columns['text']) - 1] = span['lines']
+            columnar_pages[page_num] = columns
+
+        return {
+            'fonts': list(fonts),
+            'colors': [list(color) for color in colors],
+            'pages': columnar_pages
+        }
+
+    @staticmethod
+    def apply_requested_format(result):
+        """Re-encode a page-window result if the client asked for ?format=columnar"""
+        if request.args.get('format') == 'columnar':
+            result['pages'] = PayloadFormat.to_columnar(result['pages'])
+            result['format'] = 'columnar'
+        return result
+
+    @staticmethod
+    def compress_response(response):
+        """Brotli or gzip encode large JSON responses the client accepts"""
+        if (
+            response.direct_passthrough
+            or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers
+            or not 200 <= response.status_code < 300
+        ):
+            return response
+
+        data = response.get_data()
+        if len(data) < Config.COMPRESSION_MIN_BYTES:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        if brotli is not None and request.accept_encodings['br']:
+            response.set_data(brotli.compress(data, quality=5))
+            response.headers['Content-Encoding'] = 'br'
+        elif request.accept_encodings['gzip']:
+            response.set_data(gzip.compress(data, compresslevel=6))
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
@@ -1,9 +1,36 @@
 import fitz
+import math
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from app.config import Config
 from app.font_utils import get_fallback_font, preserve_text_attributes
+from app.font_metrics import FontMetrics
+from app.document_cache import DocumentCache
 from .text_color_handler import ColorHandler
 from .link_handler import LinkHandler
 
+def _extract_page_range(pdf_path, start, count, granularity):
+    """Pool worker: extract a contiguous page range with its own document handle"""
+    doc = fitz.open(pdf_path)
+    try:
+        return [
+            (page_num, PDFHandler.extract_page_spans(doc[page_num], granularity))
+            for page_num in range(start, min(start + count, doc.page_count))
+        ]
+    finally:
+        doc.close()
+
 class PDFHandler:
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    # Bump whenever extracted span output changes so cached results are not reused
+    EXTRACTOR_VERSION = 2
+
+    # Supported extraction granularities, finest first
+    GRANULARITIES = ('span', 'line', 'block')
+
     # Built-in font mappings
     FONTS = {
         'normal': 'Helvetica',
@@ -49,48 +76,145 @@ class PDFHandler:
                 return 'Helvetica-Oblique'
             return 'Helvetica'
 
+    @staticmethod
+    def _same_attributes(a, b):
+        return (a['font'], a['size'], a['flags'], a['color']) == (b['font'], b['size'], b['flags'], b['color'])
+
+    @staticmethod
+    def _union_bbox(a, b):
+        return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+    @staticmethod
+    def extract_page_spans(page, granularity='span'):
+        """Extract text entries and their attributes from a single page.
+
+        At 'line' granularity adjacent spans of a line with identical attributes
+        are merged; at 'block' granularity whole lines of a block that share
+        attributes are merged too, keeping each line's bbox under 'lines'.
+        """
+        blocks = []
+        text_page = page.get_text("dict")  # Use dict instead of rawdict
+
+        for block in text_page["blocks"]:
+            if "lines" in block:
+                previous_line = None  # Entries of the previous line in this block
+                for line in block["lines"]:
+                    line_entries = []
+                    for span in line["spans"]:
+                        if 'text' not in span:
+                            continue
+
+                        # Ensure proper color format
+                        color = span.get('color', 0)
+                        if isinstance(color, int):
+                            color = [0, 0, 0]
+                        elif isinstance(color, (list, tuple)):
+                            color = list(color[:3])
+                        else:
+                            color = [0, 0, 0]
+
+                        entry = {
+                            'text': span['text'],
+                            'bbox': span['bbox'],
+                            'font': span.get('font', 'helv'),
+                            'size': span.get('size', 12),
+                            'flags': span.get('flags', 0),
+                            'color': color
+                        }
+
+                        if granularity != 'span' and line_entries and PDFHandler._same_attributes(line_entries[-1], entry):
+                            line_entries[-1]['text'] += entry['text']
+                            line_entries[-1]['bbox'] = PDFHandler._union_bbox(line_entries[-1]['bbox'], entry['bbox'])
+                        else:
+                            line_entries.append(entry)
+
+                    # Fold a uniform line into a uniform previous line of the same block
+                    if (
+                        granularity == 'block' and len(line_entries) == 1
+                        and previous_line is not None and len(previous_line) == 1
+                        and PDFHandler._same_attributes(previous_line[0], line_entries[0])
+                    ):
+                        merged = previous_line[0]
+                        merged.setdefault('lines', [merged['bbox']]).append(line_entries[0]['bbox'])
+                        merged['text'] += '\n' + line_entries[0]['text']
+                        merged['bbox'] = PDFHandler._union_bbox(merged['bbox'], line_entries[0]['bbox'])
+                        continue
+
+                    blocks.extend(line_entries)
+                    previous_line = line_entries
+
+        for entry in blocks:
+            entry['text'] = '\n'.join(text.strip() for text in entry['text'].split('\n'))
+
+        return blocks
+
+    @staticmethod
+    def _get_executor():
+        """Lazily create the process pool shared by parallel extractions"""
+        with PDFHandler._executor_lock:
+            if PDFHandler._executor is None:
+                PDFHandler._executor = ProcessPoolExecutor(
+                    max_workers=Config.EXTRACTION_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return PDFHandler._executor
+
+    @staticmethod
+    def iter_text_with_attributes(pdf_path, start=0, count=None, parallel=True, granularity='span'):
+        """Yield (page_number, spans) for a window of pages, one page at a time"""
+        with DocumentCache.checkout(pdf_path) as doc:
+            start = max(start, 0)
+            stop = doc.page_count if count is None else min(start + count, doc.page_count)
+
+            # Small ranges stay serial to avoid pool overhead
+            if not parallel or stop - start < Config.PARALLEL_EXTRACTION_MIN_PAGES or Config.EXTRACTION_WORKERS < 2:
+                for page_num in range(start, stop):
+                    yield page_num, PDFHandler.extract_page_spans(doc[page_num], granularity)
+                return
+
+        # Several chunks per worker keeps cores busy when page cost is uneven
+        chunk_size = max(math.ceil((stop - start) / (Config.EXTRACTION_WORKERS * 4)), 1)
+        executor = PDFHandler._get_executor()
+        futures = [
+            executor.submit(_extract_page_range, pdf_path, chunk_start, min(chunk_size, stop - chunk_start), granularity)
+            for chunk_start in range(start, stop, chunk_size)
+        ]
+
+        # Merge in page order, streaming each chunk as soon as it is ready
+        for future in futures:
+            yield from future.result()
+
     @staticmethod
     def extract_text_with_attributes(pdf_path):
         """Extract text and its attributes from PDF"""
-        doc = fitz.open(pdf_path)
         pages_data = []
-        
-        for page in doc:
-            blocks = []
-            text_page = page.get_text("dict")  # Use dict instead of rawdict
-            
-            for block in text_page["blocks"]:
-                if "lines" in block:
-                    for line in block["lines"]:
-                        for span in line["spans"]:
-                            if 'text' not in span:
-                                continue
-                                
-                            # Ensure proper color format
-                            color = span.get('color', 0)
-                            if isinstance(color, int):
-                                color = [0, 0, 0]
-                            elif isinstance(color, (list, tuple)):
-                                color = list(color[:3])
-                            else:
-                                color = [0, 0, 0]
-
-                            blocks.append({
-                                'text': span['text'].strip(),
-                                'bbox': span['bbox'],
-                                'font': span.get('font', 'helv'),
-                                'size': span.get('size', 12),
-                                'flags': span.get('flags', 0),
-                                'color': color
-                            })
-            
+
+        for _, blocks in PDFHandler.iter_text_with_attributes(pdf_path):
             # Only add pages with content
             if blocks:
                 pages_data.append(blocks)
-        
-        doc.close()
+
         return pages_data
 
+    @staticmethod
+    def get_page_count(pdf_path):
+        """Return the number of pages without extracting any text"""
+        with DocumentCache.checkout(pdf_path) as doc:
+            return doc.page_count
+
+    @staticmethod
+    def has_text(pdf_path):
+        """Check whether any page carries extractable text, stopping at the first hit"""
+        with DocumentCache.checkout(pdf_path) as doc:
+            return any(page.get_text("text").strip() for page in doc)
+
+    @staticmethod
+    def find_image_only_pages(pdf_path):
+        """Pages that show images but use no fonts, i.e. scans that need OCR"""
+        with DocumentCache.checkout(pdf_path) as doc:
+            # Only page resources are inspected, content streams are not parsed
+            return [page.number for page in doc if page.get_images() and not page.get_fonts()]
+
     @staticmethod
     def normalize_color(color):
         """Convert color values to range 0-1"""
@@ -106,14 +230,8 @@ class PDFHandler:
     def get_text_width(text, font_name, font_size):
         """Calculate exact width of text in points"""
         try:
-            # Create a temp doc to measure text
-            doc = fitz.Document()
-            page = doc.new_page()
-            # Get text width using built-in function
-            tw = page.get_text_width(text, fontname=font_name, fontsize=font_size)
-            doc.close()
-            return tw
-        except:
+            return FontMetrics.text_width(text, font_name, font_size)
+        except Exception:
             # Fallback: estimate based on average character width
             return len(text) * (font_size * 0.5)  # Approximate width
 
@@ -121,39 +239,76 @@ class PDFHandler:
     def update_text(pdf_path, changes):
         """Apply text changes to PDF"""
         doc = fitz.open(pdf_path)
-        
+        PDFHandler.apply_changes(doc, changes)
+        return doc
+
+    @staticmethod
+    def layout_lines(line_boxes, text):
+        """Pair each line of text with a line box, continuing the line spacing past the last box"""
+        if len(line_boxes) == 1:
+            return [(line_boxes[0], text)]
+
+        pitch = (line_boxes[-1][3] - line_boxes[0][3]) / (len(line_boxes) - 1)
+        placed = []
+        for index, line_text in enumerate(text.split('\n')):
+            if index < len(line_boxes):
+                line_box = line_boxes[index]
+            else:
+                x0, y0, x1, y1 = line_boxes[-1]
+                shift = pitch * (index - len(line_boxes) + 1)
+                line_box = (x0, y0 + shift, x1, y1 + shift)
+            placed.append((line_box, line_text))
+        return placed
+
+    @staticmethod
+    def apply_changes(doc, changes):
+        """Replace text page by page with one redaction pass and one text write per page"""
         for page_num, page_changes in changes.items():
             page = doc[int(page_num)]
+            link_changes = []
+            # All replacement text for the page goes into one content stream
+            shape = page.new_shape()
             
             for change in page_changes:
+                # Remove the original glyphs rather than painting over them;
+                # merged blocks are redacted line by line so neighbours survive
+                line_boxes = change.get('lines') or [change['bbox']]
+                for line_box in line_boxes:
+                    page.add_redact_annot(fitz.Rect(line_box), fill=(1, 1, 1))
+                
                 if LinkHandler.is_link_text(change['new_text']):
-                    LinkHandler.apply_link_to_text(
-                        doc, int(page_num), change['new_text'], 
-                        change['bbox'], change.get('color')
-                    )
-                else:
-                    x0, y0, x1, y1 = change['bbox']
-                    
-                    # Get proper built-in font
-                    font_name = PDFHandler.get_font_name(change.get('font', 'Helvetica'))
-                    
-                    # White out original text
-                    page.draw_rect([x0, y0, x1, y1], 
-                                 color=(1, 1, 1), 
-                                 fill=(1, 1, 1))
-                    
-                    # Adjust position - move bold text down by 1
-                    x_offset = 1 if 'Bold' in font_name else 0
-                    y_offset = 3 if 'Bold' in font_name else 3  # Same y-offset for both now
-                    
-                    # Insert new text with proper font and adjusted position
-                    color = PDFHandler.normalize_color(change.get('color', [0, 0, 0]))
-                    page.insert_text(
-                        point=(x0 + x_offset, y1 - y_offset),
-                        text=change['new_text'],
+                    link_changes.append(change)
+                    continue
+                
+                # Get proper built-in font
+                font_name = PDFHandler.get_font_name(change.get('font', 'Helvetica'))
+                
+                # Adjust position - move bold text down by 1
+                x_offset = 1 if 'Bold' in font_name else 0
+                y_offset = 3 if 'Bold' in font_name else 3  # Same y-offset for both now
+                
+                # Insert new text with proper font and adjusted position
+                color = PDFHandler.normalize_color(change.get('color', [0, 0, 0]))
+                for line_box, line_text in PDFHandler.layout_lines(line_boxes, change['new_text']):
+                    x0, y0, x1, y1 = line_box
+                    shape.insert_text(
+                        (x0 + x_offset, y1 - y_offset),
+                        line_text,
                         fontname=font_name,
                         fontsize=change['size'],
                         color=color
                     )
+            
+            page.apply_redactions(
+                images=fitz.PDF_REDACT_IMAGE_NONE,
+                graphics=fitz.PDF_REDACT_LINE_ART_NONE
+            )
+            shape.commit()
+            
+            for change in link_changes:
+                LinkHandler.apply_link_to_text(
+                    doc, int(page_num), change['new_text'],
+                    change['bbox'], change.get('color')
+                )
         
         return doc
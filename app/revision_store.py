@@ -0,0 +1,73 @@
+import os
+import shutil
+
+class RevisionStore:
+    """On-disk undo/redo material for a working copy.
+
+    Most revisions are incremental updates appended to the working copy, so
+    stepping back truncates the file and keeps the cut-off bytes (just the
+    objects of the pages that changed) for redo. Revisions that replaced the
+    whole file swap full snapshots in and out instead.
+    """
+
+    @staticmethod
+    def _dir(working_path):
+        return f"{working_path}.revisions"
+
+    @staticmethod
+    def snapshot_path(working_path, revision):
+        return os.path.join(RevisionStore._dir(working_path), f"{revision}.pdf")
+
+    @staticmethod
+    def delta_path(working_path, revision):
+        return os.path.join(RevisionStore._dir(working_path), f"{revision}.delta")
+
+    @staticmethod
+    def clear(working_path):
+        """Forget all stored revisions"""
+        shutil.rmtree(RevisionStore._dir(working_path), ignore_errors=True)
+
+    @staticmethod
+    def discard(working_path, entries):
+        """Remove whatever is stored for the given history entries"""
+        for entry in entries:
+            for path in (
+                RevisionStore.snapshot_path(working_path, entry['revision']),
+                RevisionStore.delta_path(working_path, entry['revision'])
+            ):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    @staticmethod
+    def stash_working(working_path, revision):
+        """Move the working copy aside as the full snapshot of a revision"""
+        os.makedirs(RevisionStore._dir(working_path), exist_ok=True)
+        os.replace(working_path, RevisionStore.snapshot_path(working_path, revision))
+
+    @staticmethod
+    def step_back(working_path, current, previous):
+        """Turn the working copy from the current revision into the previous one"""
+        if current['base']:
+            RevisionStore.stash_working(working_path, current['revision'])
+            os.replace(RevisionStore.snapshot_path(working_path, previous['revision']), working_path)
+            return
+
+        os.makedirs(RevisionStore._dir(working_path), exist_ok=True)
+        with open(working_path, 'r+b') as f:
+            f.seek(previous['size'])
+            with open(RevisionStore.delta_path(working_path, current['revision']), 'wb') as delta:
+                shutil.copyfileobj(f, delta)
+            f.truncate(previous['size'])
+
+    @staticmethod
+    def step_forward(working_path, current, following):
+        """Turn the working copy from the current revision into the following one"""
+        if following['base']:
+            RevisionStore.stash_working(working_path, current['revision'])
+            os.replace(RevisionStore.snapshot_path(working_path, following['revision']), working_path)
+            return
+
+        delta_path = RevisionStore.delta_path(working_path, following['revision'])
+        with open(working_path, 'ab') as f, open(delta_path, 'rb') as delta:
+            shutil.copyfileobj(delta, f)
+        os.remove(delta_path)
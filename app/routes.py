@@ -1,32 +1,99 @@
+import base64
 import os
+import re
+import shutil
 from flask import Blueprint, render_template, request, jsonify, send_file, current_app
 from werkzeug.utils import secure_filename
 from app.pdf_utils import PDFHandler
 from app.ocr_processing import OCRProcessor
+from app.ocr_jobs import OCRJobQueue
 from app.config import Config
 from app.file_cleanup import FileCleanup
-from datetime import datetime, timedelta
+from app.extraction_cache import ExtractionCache
+from app.edit_session import EditSession
+from app.session_storage import SessionStorage
+from app.payload_format import PayloadFormat
+from app.page_renderer import PageRenderer
+from app.span_table import SpanTable
+from app.edit_journal import EditJournal
+from app.search_index import SearchIndex
+from datetime import datetime
 
 bp = Blueprint('main', __name__)
 
-# Add this function to handle file cleanup
-def cleanup_old_files():
-    now = datetime.now()
-    retention_period = Config.FILE_RETENTION_PERIOD.total_seconds()
-    
-    for filename in os.listdir(Config.UPLOAD_FOLDER):
-        file_path = os.path.join(Config.UPLOAD_FOLDER, filename)
-        file_modified = os.path.getmtime(file_path)
-        if (now - datetime.fromtimestamp(file_modified)).total_seconds() > retention_period:
-            try:
-                os.remove(file_path)
-            except OSError:
-                pass
+@bp.after_request
+def attach_session_cookie(response):
+    return SessionStorage.attach_cookie(response)
+
+@bp.after_request
+def compress_response(response):
+    return PayloadFormat.compress_response(response)
+
+def session_file_path(filename):
+    """Path of a file in the caller's session directory, or None without a session"""
+    token = SessionStorage.get_token()
+    return SessionStorage.file_path(token, filename) if token else None
 
 @bp.route('/', methods=['GET'])
 def index():
     return render_template('index.html')
 
+def requested_granularity():
+    """Extraction granularity asked for with ?granularity=, or None if unsupported"""
+    granularity = request.args.get('granularity', 'span')
+    return granularity if granularity in PDFHandler.GRANULARITIES else None
+
+def extract_page_window(filepath, filename, start, count, granularity='span'):
+    """Extract one window of pages and describe where the next window starts"""
+    key = ExtractionCache.make_key(ExtractionCache.hash_file(filepath), PDFHandler.EXTRACTOR_VERSION)
+    meta = ExtractionCache.get_meta(key)
+    if meta is None:
+        meta = {'page_count': PDFHandler.get_page_count(filepath)}
+        ExtractionCache.put_meta(key, meta)
+        ExtractionCache.evict_in_background()
+    page_count = meta['page_count']
+    stop = min(start + count, page_count)
+
+    # Serve cached pages, extracting only from the first miss onwards
+    window = {}
+    for page_num in range(start, stop):
+        spans = ExtractionCache.get_page(key, page_num, granularity)
+        if spans is None:
+            for extracted_num, blocks in PDFHandler.iter_text_with_attributes(
+                filepath, page_num, stop - page_num, granularity=granularity
+            ):
+                ExtractionCache.put_page(key, extracted_num, blocks, granularity)
+                window[extracted_num] = blocks
+            break
+        window[page_num] = spans
+
+    # Ids let /edit address spans without echoing their attributes back
+    pages = {}
+    for page_num, blocks in window.items():
+        if blocks:
+            SpanTable.register(filepath, key, page_num, granularity, blocks)
+            pages[str(page_num)] = SpanTable.with_ids(page_num, granularity, blocks)
+    next_start = stop if stop < page_count else None
+
+    return {
+        'status': 'success',
+        'filename': filename,
+        'page_count': page_count,
+        'start': start,
+        'next_start': next_start,
+        'granularity': granularity,
+        'pages': pages
+    }
+
+def find_ocr_pages(filepath):
+    """Image-only pages of a document, remembered in the extraction cache"""
+    key = ExtractionCache.make_key(ExtractionCache.hash_file(filepath), PDFHandler.EXTRACTOR_VERSION)
+    meta = ExtractionCache.get_meta(key) or {'page_count': PDFHandler.get_page_count(filepath)}
+    if 'image_only_pages' not in meta:
+        meta['image_only_pages'] = PDFHandler.find_image_only_pages(filepath)
+        ExtractionCache.put_meta(key, meta)
+    return meta['image_only_pages']
+
 @bp.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
@@ -36,39 +103,69 @@ def upload_file():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
         
+    granularity = requested_granularity()
+    if granularity is None:
+        return jsonify({'error': 'Unsupported granularity'}), 400
+
     if file and file.filename.endswith('.pdf'):
+        # The body was sniffed and hashed while it streamed to disk
+        upload = file.stream
+        error = upload.validate()
+        if error:
+            return jsonify({'status': 'error', 'error': error}), 400
+
         try:
             filename = secure_filename(file.filename)
-            filepath = os.path.join(Config.UPLOAD_FOLDER, filename)
-            file.save(filepath)
+            token = SessionStorage.get_token(create=True)
+            os.makedirs(SessionStorage.session_dir(token), exist_ok=True)
+            filepath = SessionStorage.file_path(token, filename)
+            upload.commit(filepath)
+            ExtractionCache.remember_hash(filepath, upload.digest)
             
             # Start countdown thread
-            FileCleanup.start_countdown_thread(2, filename)
+            FileCleanup.start_countdown_thread(2, token)
             
-            # Process PDF without OCR first
-            pages_data = PDFHandler.extract_text_with_attributes(filepath)
+            # Reuse an earlier OCR result for the same upload bytes
+            upload_key = ExtractionCache.make_key(ExtractionCache.hash_file(filepath), PDFHandler.EXTRACTOR_VERSION)
+            cached_ocr_path = ExtractionCache.get_file(upload_key, 'ocr.pdf')
+            if cached_ocr_path:
+                shutil.copyfile(cached_ocr_path, filepath)
             
-            # Only use OCR if no text was extracted
-            if not any(pages_data):
-                ocr_path = OCRProcessor.process_pdf(filepath)
-                pages_data = PDFHandler.extract_text_with_attributes(ocr_path)
+            # Process the first window of pages without OCR
+            result = extract_page_window(filepath, filename, 0, Config.PAGE_WINDOW_SIZE, granularity)
             
-            # Format pages
-            formatted_pages = {
-                str(i): page for i, page in enumerate(pages_data) if page
-            }
-            
-            if not formatted_pages:
+            # OCR only the scanned pages, and never inside the request:
+            # the client polls /jobs and merges those pages in when ready
+            ocr_pages = find_ocr_pages(filepath)
+            if ocr_pages and not OCRProcessor.check_dependencies():
+                ocr_error = f"OCR is unavailable, missing: {', '.join(OCRProcessor.missing_tools())}"
+                if len(ocr_pages) == result['page_count']:
+                    return jsonify({
+                        'status': 'error',
+                        'error': ocr_error
+                    }), 503
+                result['ocr_error'] = ocr_error
+                result['ocr_pages'] = ocr_pages
+            elif ocr_pages:
+                job_id = OCRJobQueue.submit(filepath, filename, upload_key, ocr_pages)
+                if len(ocr_pages) == result['page_count']:
+                    return jsonify({
+                        'status': 'processing',
+                        'filename': filename,
+                        'job_id': job_id
+                    }), 202
+                result['ocr_job_id'] = job_id
+                result['ocr_pages'] = ocr_pages
+            elif not result['pages'] and not PDFHandler.has_text(filepath):
                 return jsonify({
                     'status': 'error',
                     'error': 'No text extracted from PDF'
                 }), 400
+            else:
+                # OCR'd documents are indexed on their first search instead
+                SearchIndex.build_in_background(filepath)
                 
-            return jsonify({
-                'status': 'success',
-                'filename': filename,
-                'pages': formatted_pages
-            })
+            return jsonify(PayloadFormat.apply_requested_format(result))
             
         except Exception as e:
             print(f"Upload error: {str(e)}")
@@ -79,50 +176,345 @@ def upload_file():
     
     return jsonify({'error': 'Invalid file type'}), 400
 
+@bp.route('/pages/<filename>', methods=['GET'])
+def get_pages(filename):
+    """Serve a window of extracted pages so the editor can load lazily"""
+    filepath = session_file_path(filename)
+    if not filepath or not os.path.exists(filepath):
+        return jsonify({'error': 'File not found'}), 404
+
+    granularity = requested_granularity()
+    if granularity is None:
+        return jsonify({'error': 'Unsupported granularity'}), 400
+
+    start = max(request.args.get('start', 0, type=int), 0)
+    count = request.args.get('count', Config.PAGE_WINDOW_SIZE, type=int)
+    count = min(max(count, 1), Config.MAX_PAGE_WINDOW_SIZE)
+
+    try:
+        result = extract_page_window(filepath, secure_filename(filename), start, count, granularity)
+        return jsonify(PayloadFormat.apply_requested_format(result))
+    except Exception as e:
+        print(f"Page window error: {str(e)}")
+        return jsonify({
+            'status': 'error',
+            'error': str(e)
+        }), 500
+
+@bp.route('/search/<filename>', methods=['GET'])
+def search_document(filename):
+    """Find a word or phrase (?q=), or words starting with it (&mode=prefix)"""
+    filepath = session_file_path(filename)
+    if not filepath or not os.path.exists(filepath):
+        return jsonify({'error': 'File not found'}), 404
+
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Missing query'}), 400
+    mode = request.args.get('mode', 'phrase')
+    if mode not in ('phrase', 'prefix'):
+        return jsonify({'error': 'Unsupported search mode'}), 400
+
+    try:
+        hits, total = SearchIndex.search(filepath, query, prefix=mode == 'prefix', limit=Config.SEARCH_MAX_HITS)
+    except Exception as e:
+        print(f"Search error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    return jsonify({
+        'query': query,
+        'mode': mode,
+        'count': total,
+        'truncated': total > len(hits),
+        'hits': hits
+    })
+
+@bp.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Report progress of a background OCR job"""
+    job = OCRJobQueue.get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
 @bp.route('/edit', methods=['POST'])
 def edit_pdf():
-    cleanup_old_files()  # Call cleanup before processing edit
-    
-    # Check if file is too old
     data = request.json
     filename = data['filename']
-    filepath = os.path.join(Config.UPLOAD_FOLDER, secure_filename(filename))
+    filepath = session_file_path(filename)
     
-    if os.path.exists(filepath):
-        modified_time = datetime.fromtimestamp(os.path.getmtime(filepath))
-        if datetime.now() - modified_time > Config.FILE_RETENTION_PERIOD:
-            try:
-                os.remove(filepath)
-            except:
-                pass
-            return jsonify({'error': 'File has expired'}), 410
+    if not filepath or not os.path.exists(filepath):
+        return jsonify({'error': 'File not found'}), 404
     
-    changes = data['changes']
+    # Expiry is an indexed lookup; the background reaper does the deleting
+    expiry_time = FileCleanup.get_expiry(SessionStorage.get_token())
+    if expiry_time is None or expiry_time <= datetime.now():
+        return jsonify({'error': 'File has expired'}), 410
     
-    # Apply changes and save
-    doc = PDFHandler.update_text(filepath, changes)
-    output_path = os.path.join(Config.UPLOAD_FOLDER, f"edited_{filename}")
-    doc.save(output_path)
+    if 'edits' in data:
+        # {span_id: new_text} diffs against the edits already saved
+        changes, unknown = SpanTable.resolve_edits(filepath, data['edits'])
+        if unknown:
+            return jsonify({'error': 'Unknown span ids', 'span_ids': unknown}), 400
+        # Journalled ops are older than this save, so they go first
+        EditJournal.flush(filepath)
+        state = EditSession.save(filepath, changes, merge=True)
+    else:
+        # Apply only what changed since the last save as an incremental update
+        state = EditSession.save(filepath, data['changes'])
+    edited_file = os.path.basename(EditSession.working_path(filepath))
     
-    return jsonify({'success': True, 'edited_file': f"edited_{filename}"})
+    return jsonify({
+        'success': True,
+        'edited_file': edited_file,
+        'revision': state['revision'],
+        'can_undo': state['position'] > 0,
+        'can_redo': state['position'] < len(state['history']) - 1
+    })
+
+def step_revision(direction):
+    """Shared body of /undo and /redo"""
+    data = request.json
+    filepath = session_file_path(data['filename'])
+    if not filepath or not os.path.exists(filepath):
+        return jsonify({'error': 'File not found'}), 404
+
+    expiry_time = FileCleanup.get_expiry(SessionStorage.get_token())
+    if expiry_time is None or expiry_time <= datetime.now():
+        return jsonify({'error': 'File has expired'}), 410
+
+    # Journalled ops predate the request and belong to the revision being left
+    EditJournal.flush(filepath)
+    stepped = EditSession.step(filepath, direction)
+    if stepped is None:
+        return jsonify({'error': 'Nothing to undo' if direction < 0 else 'Nothing to redo'}), 409
+    state, pages = stepped
+
+    # The text now applied on each touched page, so the editor can catch up
+    page_texts = {str(page_num): [] for page_num in pages}
+    for key, change in state['applied'].items():
+        page_num = key.split(':')[0]
+        if page_num in page_texts:
+            page_texts[page_num].append({'bbox': change['bbox'], 'new_text': change['new_text']})
+
+    return jsonify({
+        'success': True,
+        'edited_file': os.path.basename(EditSession.working_path(filepath)),
+        'revision': state['revision'],
+        'can_undo': state['position'] > 0,
+        'can_redo': state['position'] < len(state['history']) - 1,
+        'pages': page_texts
+    })
+
+def replace_in_document(filepath, filename, pattern, replacement, granularity):
+    """Build {span_id: new_text} edits replacing pattern in every span's current text"""
+    state = EditSession.current_state(filepath)
+    edits = {}
+    count = 0
+    start = 0
+    while start is not None:
+        window = extract_page_window(filepath, filename, start, Config.MAX_PAGE_WINDOW_SIZE, granularity)
+        for page_num, spans in window['pages'].items():
+            for span in spans:
+                text = EditSession.current_text(state, page_num, span)
+                new_text, replaced = pattern.subn(lambda match: replacement, text)
+                if replaced:
+                    edits[span['id']] = new_text
+                    count += replaced
+        start = window['next_start']
+    return edits, count
+
+@bp.route('/replace', methods=['POST'])
+def replace_text():
+    """Find and replace across the whole document in one save"""
+    data = request.json
+    filename = data['filename']
+    filepath = session_file_path(filename)
+    if not filepath or not os.path.exists(filepath):
+        return jsonify({'error': 'File not found'}), 404
+
+    expiry_time = FileCleanup.get_expiry(SessionStorage.get_token())
+    if expiry_time is None or expiry_time <= datetime.now():
+        return jsonify({'error': 'File has expired'}), 410
+
+    if not data.get('find'):
+        return jsonify({'error': 'Nothing to find'}), 400
+    granularity = data.get('granularity', 'span')
+    if granularity not in PDFHandler.GRANULARITIES:
+        return jsonify({'error': 'Unsupported granularity'}), 400
+    flags = 0 if data.get('match_case') else re.IGNORECASE
+    pattern = re.compile(re.escape(data['find']), flags)
+
+    # Search the spans the edit engine rewrites, so every hit maps onto a
+    # bbox; journalled ops are flushed first so they are searched too
+    EditJournal.flush(filepath)
+    edits, count = replace_in_document(filepath, secure_filename(filename), pattern, data.get('replace', ''), granularity)
+    if not edits:
+        return jsonify({'success': True, 'count': 0, 'pages': [], 'edits': {}})
+
+    changes, _ = SpanTable.resolve_edits(filepath, edits)
+    state = EditSession.save(filepath, changes, merge=True)
+    return jsonify({
+        'success': True,
+        'count': count,
+        'pages': sorted({int(span_id.split(':')[0]) for span_id in edits}),
+        'edits': edits,
+        'edited_file': os.path.basename(EditSession.working_path(filepath)),
+        'revision': state['revision'],
+        'can_undo': state['position'] > 0,
+        'can_redo': state['position'] < len(state['history']) - 1
+    })
+
+@bp.route('/undo', methods=['POST'])
+def undo_edit():
+    return step_revision(-1)
+
+@bp.route('/redo', methods=['POST'])
+def redo_edit():
+    return step_revision(1)
+
+@bp.route('/journal', methods=['POST'])
+def journal_edits():
+    """Accept small {span_id: new_text} ops; they reach the PDF on the next flush"""
+    data = request.json
+    filepath = session_file_path(data['filename'])
+    if not filepath or not os.path.exists(filepath):
+        return jsonify({'error': 'File not found'}), 404
+
+    expiry_time = FileCleanup.get_expiry(SessionStorage.get_token())
+    if expiry_time is None or expiry_time <= datetime.now():
+        return jsonify({'error': 'File has expired'}), 410
+
+    edits = data['edits']
+    _, unknown = SpanTable.resolve_edits(filepath, edits)
+    if unknown:
+        return jsonify({'error': 'Unknown span ids', 'span_ids': unknown}), 400
+
+    pending_bytes = EditJournal.append(filepath, edits)
+    edited_file = os.path.basename(EditSession.working_path(filepath))
+    return jsonify({'success': True, 'edited_file': edited_file, 'pending_bytes': pending_bytes}), 202
 
 @bp.route('/download/<filename>')
 def download_file(filename):
-    """Basic file download"""
+    """Download with a strong ETag, conditional GET and byte ranges"""
     try:
-        filepath = os.path.join(Config.UPLOAD_FOLDER, secure_filename(filename))
-        if os.path.exists(filepath):
-            return send_file(filepath)
-        return "File not found", 404
+        filepath = session_file_path(filename)
+        if filepath and secure_filename(filename).startswith('edited_'):
+            # Fold in any journalled edits before handing out the working copy
+            source_path = session_file_path(secure_filename(filename)[len('edited_'):])
+            if os.path.exists(source_path):
+                EditJournal.flush(source_path)
+        if not filepath or not os.path.exists(filepath):
+            return "File not found", 404
+
+        etag = EditSession.download_etag(filepath)
+        if Config.X_ACCEL_REDIRECT_PREFIX:
+            # nginx serves the bytes (and any Range) from an internal location
+            relative_path = os.path.relpath(filepath, Config.UPLOAD_FOLDER)
+            response = current_app.response_class(mimetype='application/pdf')
+            response.headers['X-Accel-Redirect'] = Config.X_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + relative_path
+            response.set_etag(etag)
+            response.make_conditional(request)
+        else:
+            # send_file answers If-None-Match and Range itself, and hands off to
+            # the front-end server when USE_X_SENDFILE is set
+            response = send_file(filepath, etag=etag, max_age=0)
+
+        # The name stays the same across saves, so always revalidate
+        response.cache_control.no_cache = True
+        response.cache_control.private = True
+        response.cache_control.public = False
+        return response
     except Exception as e:
         print(f"Download error: {e}")
         return str(e), 500
 
+@bp.route('/render/<filename>/<int:page_num>', methods=['GET'])
+def render_page(filename, page_num):
+    """Serve a page, or one tile of it with ?tile=col,row, as PNG or WebP"""
+    filepath = session_file_path(filename)
+    if not filepath or not os.path.exists(filepath):
+        return jsonify({'error': 'File not found'}), 404
+
+    fmt = request.args.get('format', 'png')
+    if fmt not in PageRenderer.MIMETYPES:
+        return jsonify({'error': 'Unsupported format'}), 400
+    zoom = PageRenderer.clamp_zoom(request.args.get('zoom', 1.0, type=float))
+
+    tile = None
+    if 'tile' in request.args:
+        try:
+            column, row = (int(part) for part in request.args['tile'].split(','))
+        except ValueError:
+            return jsonify({'error': 'Tile must be given as column,row'}), 400
+        tile = (column, row)
+
+    # Revalidation is answered without touching the document or tile cache
+    etag = PageRenderer.etag_for(filepath, page_num, zoom, tile, fmt)
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+    else:
+        try:
+            body, etag = PageRenderer.render(filepath, page_num, zoom, tile, fmt)
+        except IndexError as e:
+            return jsonify({'error': str(e)}), 404
+        except Exception as e:
+            print(f"Render error: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+        response = send_file(body, mimetype=PageRenderer.MIMETYPES[fmt], etag=etag or False, max_age=0)
+
+    # Tiles are named after the document and page edits they show, so clients
+    # revalidate and get a 304 until an edit touches the page
+    response.cache_control.max_age = 0
+    response.cache_control.no_cache = True
+    response.cache_control.private = True
+    response.cache_control.public = False
+    return response
+
+@bp.route('/preview', methods=['POST'])
+def preview_edit():
+    """Render the pages a change set touches, as data URLs, without saving the PDF"""
+    data = request.json
+    filepath = session_file_path(data['filename'])
+    if not filepath or not os.path.exists(filepath):
+        return jsonify({'error': 'File not found'}), 404
+
+    fmt = data.get('format', 'png')
+    if fmt not in PageRenderer.MIMETYPES:
+        return jsonify({'error': 'Unsupported format'}), 400
+    zoom = PageRenderer.clamp_zoom(float(data.get('zoom', 1.0)))
+
+    try:
+        images = PageRenderer.preview(filepath, data['changes'], zoom, fmt)
+    except (IndexError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Preview error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    mimetype = PageRenderer.MIMETYPES[fmt]
+    return jsonify({
+        'success': True,
+        'pages': {
+            str(page_num): f"data:{mimetype};base64,{base64.b64encode(image).decode('ascii')}"
+            for page_num, image in images.items()
+        }
+    })
+
+@bp.route('/health/capabilities', methods=['GET'])
+def capabilities():
+    """Report OCR tool availability; pass ?refresh=1 to probe again"""
+    refresh = request.args.get('refresh', '0') in ('1', 'true', 'yes')
+    return jsonify(OCRProcessor.get_capabilities(refresh=refresh))
+
 @bp.route('/cleanup', methods=['POST'])
 def trigger_cleanup():
-    """Endpoint to trigger forced cleanup"""
+    """Endpoint to trigger forced cleanup of the caller's session"""
     try:
-        FileCleanup.force_cleanup()
+        token = SessionStorage.get_token()
+        if token:
+            FileCleanup.force_cleanup(token)
         return jsonify({'success': True, 'message': 'All files cleaned up'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -0,0 +1,319 @@
+import bisect
+import gzip
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from app.config import Config
+from app.edit_journal import EditJournal
+from app.edit_session import EditSession
+from app.extraction_cache import ExtractionCache
+from app.pdf_utils import PDFHandler
+from app.span_table import SpanTable
+
+class SearchIndex:
+    """Inverted index of a session's document: token -> positions in reading order.
+
+    Positions run across the whole document, so a phrase is a run of
+    consecutive positions and may cross span boundaries. Each position maps
+    back to a span id through span_starts. Saved edits are laid over the
+    stored index per revision, so searches see the text the working copy shows.
+    """
+    TOKEN_PATTERN = re.compile(r'\w+')
+
+    _indexes = OrderedDict()  # (session file path, digest[, revision, journal offset]) -> loaded or edited index
+    _lock = threading.Lock()
+    _build_locks = {}  # session file path -> lock held while building
+
+    @staticmethod
+    def index_path(filepath):
+        return f"{filepath}.search.json.gz"
+
+    @staticmethod
+    def tokenize(text):
+        return [(match.group().lower(), match.start(), match.end()) for match in SearchIndex.TOKEN_PATTERN.finditer(text)]
+
+    @staticmethod
+    def _iter_pages(filepath, key, granularity):
+        """Every page's spans, from the extraction cache where possible"""
+        meta = ExtractionCache.get_meta(key) or {'page_count': PDFHandler.get_page_count(filepath)}
+        page_num = 0
+        while page_num < meta['page_count']:
+            spans = ExtractionCache.get_page(key, page_num, granularity)
+            if spans is None:
+                for extracted_num, blocks in PDFHandler.iter_text_with_attributes(
+                    filepath, page_num, meta['page_count'] - page_num, granularity=granularity
+                ):
+                    ExtractionCache.put_page(key, extracted_num, blocks, granularity)
+                    yield extracted_num, blocks
+                return
+            yield page_num, spans
+            page_num += 1
+
+    @staticmethod
+    def build(filepath):
+        """Index the document once and store the index next to it in the session"""
+        digest = ExtractionCache.hash_file(filepath)
+        key = ExtractionCache.make_key(digest, PDFHandler.EXTRACTOR_VERSION)
+        granularity = Config.SEARCH_GRANULARITY
+
+        span_ids = []
+        span_starts = []
+        tokens = {}
+        position = 0
+        for page_num, spans in SearchIndex._iter_pages(filepath, key, granularity):
+            for index, span in enumerate(spans):
+                span_ids.append(SpanTable.span_id(page_num, granularity, index))
+                span_starts.append(position)
+                for token, _, _ in SearchIndex.tokenize(span['text']):
+                    tokens.setdefault(token, []).append(position)
+                    position += 1
+
+        index = {
+            'digest': digest,
+            'granularity': granularity,
+            'span_ids': span_ids,
+            'span_starts': span_starts,
+            'tokens': tokens
+        }
+        index_path = SearchIndex.index_path(filepath)
+        tmp_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(tmp_path, index_path)
+        return index
+
+    @staticmethod
+    def build_in_background(filepath):
+        """Index a fresh upload off the request thread"""
+        def run():
+            try:
+                SearchIndex.get(filepath)
+            except Exception as e:
+                print(f"Search index error: {str(e)}")
+        threading.Thread(target=run, daemon=True).start()
+
+    @staticmethod
+    def get(filepath):
+        """Return the document's index, loading or building it on first use"""
+        digest = ExtractionCache.hash_file(filepath)
+        with SearchIndex._lock:
+            index = SearchIndex._indexes.get((filepath, digest))
+            if index is not None:
+                SearchIndex._indexes.move_to_end((filepath, digest))
+                return index
+            build_lock = SearchIndex._build_locks.setdefault(filepath, threading.Lock())
+
+        # One build per document even when a search races the upload's build
+        with build_lock:
+            with SearchIndex._lock:
+                index = SearchIndex._indexes.get((filepath, digest))
+            if index is None:
+                try:
+                    with gzip.open(SearchIndex.index_path(filepath), 'rt', encoding='utf-8') as f:
+                        index = json.load(f)
+                except (OSError, ValueError):
+                    index = None
+                # Rebuilt after OCR replaces the document
+                if index is None or index['digest'] != digest or index['granularity'] != Config.SEARCH_GRANULARITY:
+                    index = SearchIndex.build(filepath)
+
+        # Sorted vocabulary answers prefix queries with a binary search
+        if 'vocabulary' not in index:
+            index['vocabulary'] = sorted(index['tokens'])
+        with SearchIndex._lock:
+            SearchIndex._indexes[(filepath, digest)] = index
+            while len(SearchIndex._indexes) > Config.SEARCH_INDEX_MAX_DOCUMENTS:
+                SearchIndex._indexes.popitem(last=False)
+            SearchIndex._build_locks.pop(filepath, None)
+        return index
+
+    @staticmethod
+    def _page_spans(filepath, key, page_num, granularity):
+        spans = ExtractionCache.get_page(key, page_num, granularity)
+        if spans is None:
+            spans = next(PDFHandler.iter_text_with_attributes(
+                filepath, page_num, 1, parallel=False, granularity=granularity
+            ))[1]
+            ExtractionCache.put_page(key, page_num, spans, granularity)
+        return spans
+
+    @staticmethod
+    def _contains(outer, inner, slack=0.5):
+        return (
+            inner[0] >= outer[0] - slack and inner[1] >= outer[1] - slack
+            and inner[2] <= outer[2] + slack and inner[3] <= outer[3] + slack
+        )
+
+    @staticmethod
+    def _current_texts(filepath, key, state, page_num, spans):
+        """What the indexed spans of an edited page read in the working copy.
+
+        Edits may come from another granularity: one covering whole indexed
+        spans puts its text in the first of them, and indexed spans holding
+        smaller edits are rebuilt from the page's individual spans.
+        """
+        texts = [span['text'] for span in spans]
+        rebuilt = set()
+        for change_key, change in state['applied'].items():
+            if int(change_key.split(':')[0]) != page_num:
+                continue
+            covered = [i for i, span in enumerate(spans) if SearchIndex._contains(change['bbox'], span['bbox'])]
+            if covered:
+                texts[covered[0]] = change['new_text']
+                for i in covered[1:]:
+                    texts[i] = ''
+            else:
+                rebuilt.update(i for i, span in enumerate(spans) if SearchIndex._contains(span['bbox'], change['bbox']))
+
+        if rebuilt:
+            pieces = SearchIndex._page_spans(filepath, key, page_num, 'span')
+            for i in rebuilt:
+                texts[i] = ''.join(
+                    EditSession.current_text(state, page_num, piece)
+                    for piece in pieces if SearchIndex._contains(spans[i]['bbox'], piece['bbox'])
+                )
+        return texts
+
+    @staticmethod
+    def with_edits(filepath, index):
+        """The index as the working copy reads, once per saved revision.
+
+        Ops still in the edit journal are laid over the saved edits instead of
+        being flushed, so searching never writes a revision of its own.
+        """
+        state = EditSession.current_state(filepath)
+        journalled, journal_end = EditJournal.pending(filepath)
+        if not journalled and not (state and state['applied']):
+            return index
+        cache_key = (filepath, index['digest'], state['revision'] if state else None, journal_end)
+        with SearchIndex._lock:
+            edited = SearchIndex._indexes.get(cache_key)
+            if edited is not None:
+                SearchIndex._indexes.move_to_end(cache_key)
+                return edited
+
+        state = EditSession.with_changes(state, SpanTable.resolve_edits(filepath, journalled)[0])
+        if not state['applied']:
+            return index
+
+        # Untouched spans keep their stored tokens, read back in position order
+        sequence = [None] * sum(len(positions) for positions in index['tokens'].values())
+        for token, positions in index['tokens'].items():
+            for position in positions:
+                sequence[position] = token
+        span_starts = index['span_starts'] + [len(sequence)]
+
+        key = ExtractionCache.make_key(index['digest'], PDFHandler.EXTRACTOR_VERSION)
+        edited_pages = {int(change_key.split(':')[0]) for change_key in state['applied']}
+        edited = {'span_starts': [], 'tokens': {}, 'texts': {}}
+        position = 0
+        span_index = 0
+        span_ids = index['span_ids']
+        while span_index < len(span_ids):
+            page_num = int(span_ids[span_index].split(':')[0])
+            page_end = span_index
+            while page_end < len(span_ids) and int(span_ids[page_end].split(':')[0]) == page_num:
+                page_end += 1
+
+            if page_num in edited_pages:
+                spans = SearchIndex._page_spans(filepath, key, page_num, index['granularity'])
+                texts = SearchIndex._current_texts(filepath, key, state, page_num, spans)
+                page_tokens = []
+                for span, text in zip(spans, texts):
+                    page_tokens.append([token for token, _, _ in SearchIndex.tokenize(text)])
+                    if text != span['text']:
+                        edited['texts'][SpanTable.span_id(page_num, index['granularity'], len(page_tokens) - 1)] = text
+            else:
+                page_tokens = [sequence[span_starts[i]:span_starts[i + 1]] for i in range(span_index, page_end)]
+
+            for span_tokens in page_tokens:
+                edited['span_starts'].append(position)
+                for token in span_tokens:
+                    edited['tokens'].setdefault(token, []).append(position)
+                    position += 1
+            span_index = page_end
+
+        edited = dict(index, **edited, vocabulary=sorted(edited['tokens']))
+        with SearchIndex._lock:
+            SearchIndex._indexes[cache_key] = edited
+            while len(SearchIndex._indexes) > Config.SEARCH_INDEX_MAX_DOCUMENTS:
+                SearchIndex._indexes.popitem(last=False)
+        return edited
+
+    @staticmethod
+    def _positions(index, token, prefix):
+        if not prefix:
+            return index['tokens'].get(token, [])
+        vocabulary = index['vocabulary']
+        positions = []
+        for i in range(bisect.bisect_left(vocabulary, token), len(vocabulary)):
+            if not vocabulary[i].startswith(token):
+                break
+            positions.extend(index['tokens'][vocabulary[i]])
+        return sorted(positions)
+
+    @staticmethod
+    def _hit_bbox(span, token_index, token_count):
+        """Box of a run of tokens inside one span, placed by font metrics"""
+        tokens = SearchIndex.tokenize(span['text'])
+        if 'lines' in span or token_index >= len(tokens):
+            return span['bbox']
+        start = tokens[token_index][1]
+        end = tokens[min(token_index + token_count, len(tokens)) - 1][2]
+
+        # Scale measured widths onto the span's actual extent
+        x0, y0, x1, y1 = span['bbox']
+        full_width = PDFHandler.get_text_width(span['text'], span['font'], span['size']) or 1
+        scale = (x1 - x0) / full_width
+        left = x0 + PDFHandler.get_text_width(span['text'][:start], span['font'], span['size']) * scale
+        right = x0 + PDFHandler.get_text_width(span['text'][:end], span['font'], span['size']) * scale
+        return [left, y0, min(right, x1), y1]
+
+    @staticmethod
+    def search(filepath, query, prefix=False, limit=None):
+        """Find a word or phrase; with prefix=True its last word matches as a prefix.
+
+        Returns (hits, total matches). Each hit lists the spans it covers with
+        their page and the box of the matched words.
+        """
+        terms = [token for token, _, _ in SearchIndex.tokenize(query)]
+        if not terms:
+            return [], 0
+        index = SearchIndex.with_edits(filepath, SearchIndex.get(filepath))
+
+        # Candidates come from the first term; later terms are checked by set lookup
+        following = [
+            set(SearchIndex._positions(index, term, prefix and i == len(terms) - 1))
+            for i, term in enumerate(terms[1:], start=1)
+        ]
+        starts = [
+            position for position in SearchIndex._positions(index, terms[0], prefix and len(terms) == 1)
+            if all(position + offset in positions for offset, positions in enumerate(following, start=1))
+        ]
+
+        hits = []
+        span_starts = index['span_starts']
+        for start in starts[:limit]:
+            pieces = []
+            position, remaining = start, len(terms)
+            while remaining:
+                span_index = bisect.bisect_right(span_starts, position) - 1
+                span_id = index['span_ids'][span_index]
+                span_end = span_starts[span_index + 1] if span_index + 1 < len(span_starts) else position + remaining
+                count = min(remaining, span_end - position)
+                entry = SpanTable.lookup(filepath, span_id)
+                if entry is not None:
+                    page_num, span = entry
+                    if span_id in index.get('texts', {}):
+                        span = dict(span, text=index['texts'][span_id])
+                    pieces.append({
+                        'span_id': span_id,
+                        'page': page_num,
+                        'bbox': SearchIndex._hit_bbox(span, position - span_starts[span_index], count)
+                    })
+                position += count
+                remaining -= count
+            hits.append({'page': pieces[0]['page'] if pieces else None, 'spans': pieces})
+        return hits, len(starts)
@@ -0,0 +1,53 @@
+import os
+import re
+import shutil
+import uuid
+from flask import g, request
+from werkzeug.utils import secure_filename
+from app.config import Config
+
+class SessionStorage:
+    """Per-session upload directories, identified by a token cookie"""
+    COOKIE_NAME = 'pdf_session'
+    TOKEN_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+    @staticmethod
+    def get_token(create=False):
+        """Return the caller's session token, optionally starting a new session"""
+        token = request.cookies.get(SessionStorage.COOKIE_NAME, '')
+        if SessionStorage.TOKEN_PATTERN.match(token):
+            return token
+        if not create:
+            return None
+
+        token = uuid.uuid4().hex
+        g.new_session_token = token
+        return token
+
+    @staticmethod
+    def attach_cookie(response):
+        """Hand a newly created session token to the client"""
+        token = g.pop('new_session_token', None)
+        if token:
+            response.set_cookie(
+                SessionStorage.COOKIE_NAME, token,
+                httponly=True, samesite='Lax', secure=request.is_secure
+            )
+        return response
+
+    @staticmethod
+    def session_dir(token):
+        return os.path.join(Config.UPLOAD_FOLDER, token)
+
+    @staticmethod
+    def file_path(token, filename):
+        """Path of a file inside a session directory"""
+        return os.path.join(SessionStorage.session_dir(token), secure_filename(filename))
+
+    @staticmethod
+    def teardown(token):
+        """Remove everything a session stored in one directory removal"""
+        session_dir = SessionStorage.session_dir(token)
+        if os.path.isdir(session_dir):
+            shutil.rmtree(session_dir, ignore_errors=True)
+            print(f"Removed session: {token}")
@@ -0,0 +1,99 @@
+import re
+import threading
+from collections import OrderedDict
+from app.config import Config
+from app.extraction_cache import ExtractionCache
+from app.pdf_utils import PDFHandler
+
+class SpanTable:
+    """Per-session lookup of extracted spans by the ids handed to the client.
+
+    An id is "<page>:<granularity initial><index>", e.g. "3:l12", so any
+    worker can rebuild a missing page's table from the extraction cache.
+    """
+    ID_PATTERN = re.compile(r'^(\d+):([slb])(\d+)$')
+    GRANULARITY_BY_INITIAL = {granularity[0]: granularity for granularity in PDFHandler.GRANULARITIES}
+
+    _tables = OrderedDict()  # (session file path, cache key) -> {span_id: (page_num, span)}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def span_id(page_num, granularity, index):
+        return f"{page_num}:{granularity[0]}{index}"
+
+    @staticmethod
+    def with_ids(page_num, granularity, spans):
+        """Copies of a page's spans carrying their ids"""
+        return [
+            dict(span, id=SpanTable.span_id(page_num, granularity, index))
+            for index, span in enumerate(spans)
+        ]
+
+    @staticmethod
+    def _table(filepath, key):
+        with SpanTable._lock:
+            table = SpanTable._tables.get((filepath, key))
+            if table is None:
+                table = SpanTable._tables[(filepath, key)] = {}
+                while len(SpanTable._tables) > Config.SPAN_TABLE_MAX_DOCUMENTS:
+                    SpanTable._tables.popitem(last=False)
+            SpanTable._tables.move_to_end((filepath, key))
+            return table
+
+    @staticmethod
+    def register(filepath, key, page_num, granularity, spans):
+        """Remember the spans served for one page of a session's document"""
+        table = SpanTable._table(filepath, key)
+        for index, span in enumerate(spans):
+            table[SpanTable.span_id(page_num, granularity, index)] = (page_num, span)
+
+    @staticmethod
+    def lookup(filepath, span_id):
+        """Return (page_num, span) for an id, or None if it names no span"""
+        key = ExtractionCache.make_key(ExtractionCache.hash_file(filepath), PDFHandler.EXTRACTOR_VERSION)
+        table = SpanTable._table(filepath, key)
+        entry = table.get(span_id)
+        if entry is not None:
+            return entry
+
+        # Served by another worker, or before this one restarted
+        match = SpanTable.ID_PATTERN.match(span_id)
+        if not match:
+            return None
+        page_num, granularity = int(match.group(1)), SpanTable.GRANULARITY_BY_INITIAL[match.group(2)]
+        spans = ExtractionCache.get_page(key, page_num, granularity)
+        if spans is None:
+            if page_num >= PDFHandler.get_page_count(filepath):
+                return None
+            spans = next(PDFHandler.iter_text_with_attributes(
+                filepath, page_num, 1, parallel=False, granularity=granularity
+            ))[1]
+            ExtractionCache.put_page(key, page_num, spans, granularity)
+        SpanTable.register(filepath, key, page_num, granularity, spans)
+        return table.get(span_id)
+
+    @staticmethod
+    def resolve_edits(filepath, edits):
+        """Turn {span_id: new_text} into per-page changes for EditSession.save(merge=True).
+
+        Returns (changes, unknown ids). Text equal to the original reverts the span.
+        """
+        changes = {}
+        unknown = []
+        for span_id, new_text in edits.items():
+            entry = SpanTable.lookup(filepath, span_id) if isinstance(new_text, str) else None
+            if entry is None:
+                unknown.append(span_id)
+                continue
+            page_num, span = entry
+            change = {
+                'bbox': span['bbox'],
+                'new_text': None if new_text == span['text'] else new_text,
+                'font': span['font'],
+                'size': span['size'],
+                'color': span['color']
+            }
+            if 'lines' in span:
+                change['lines'] = span['lines']
+            changes.setdefault(str(page_num), []).append(change)
+        return changes, unknown
@@ -0,0 +1,95 @@
+import hashlib
+import os
+import tempfile
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+from app.config import Config
+
+class StreamingUpload:
+    """File part of a multipart upload, hashed and checked while it is written to disk"""
+    # The PDF header may be preceded by junk, but only within the first 1024 bytes;
+    # the end-of-file marker likewise only needs to appear within the last 1024
+    HEADER_WINDOW = 1024
+    TRAILER_WINDOW = 1024
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+        self._file = os.fdopen(fd, 'w+b')
+        self._sha = hashlib.sha256()
+        self._head = b''
+        self._tail = b''
+        self.size = 0
+        self.error = None  # Set once the body is known not to be an acceptable PDF
+        self.committed = False
+
+    def write(self, data):
+        if self.error:
+            # Keep consuming the request body, but stop storing it
+            return len(data)
+
+        self.size += len(data)
+        if Config.MAX_CONTENT_LENGTH and self.size > Config.MAX_CONTENT_LENGTH:
+            self._discard()
+            raise RequestEntityTooLarge()
+
+        if len(self._head) < self.HEADER_WINDOW:
+            self._head += data[:self.HEADER_WINDOW - len(self._head)]
+            if len(self._head) >= self.HEADER_WINDOW and b'%PDF-' not in self._head:
+                self.error = 'File is not a PDF'
+                self._discard()
+                return len(data)
+
+        self._tail = (self._tail + data)[-self.TRAILER_WINDOW:]
+        self._sha.update(data)
+        return self._file.write(data)
+
+    def seek(self, offset, whence=0):
+        if self._file.closed:
+            return 0
+        return self._file.seek(offset, whence)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def _discard(self):
+        if not self._file.closed:
+            self._file.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+    def validate(self):
+        """Return why the finished upload is unacceptable, or None"""
+        if self.error:
+            return self.error
+        if b'%PDF-' not in self._head:
+            return 'File is not a PDF'
+        if b'%%EOF' not in self._tail:
+            return 'PDF is truncated'
+        return None
+
+    @property
+    def digest(self):
+        return self._sha.hexdigest()
+
+    def commit(self, filepath):
+        """Move the received file into place without copying it"""
+        self._file.close()
+        os.replace(self.temp_path, filepath)
+        self.committed = True
+
+    def close(self):
+        if not self.committed:
+            self._discard()
+
+class UploadRequest(Request):
+    """Request whose file parts stream straight into the upload folder"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Reject over-long bodies before reading any of them
+        if Config.MAX_CONTENT_LENGTH and total_content_length and total_content_length > Config.MAX_CONTENT_LENGTH:
+            raise RequestEntityTooLarge()
+        # Hidden and on the same filesystem as the sessions, so commit is a rename
+        return StreamingUpload(os.path.join(Config.UPLOAD_FOLDER, '.incoming'))